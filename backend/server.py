@@ -1,14 +1,39 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Request
+from fastapi import FastAPI, APIRouter, HTTPException, Request, Response, Query, Depends, UploadFile, File
+from fastapi.responses import StreamingResponse, JSONResponse, ORJSONResponse, PlainTextResponse, FileResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
+from starlette.routing import Match
+from starlette.datastructures import Headers, MutableHeaders
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne, ReturnDocument
+from pymongo.errors import DuplicateKeyError, OperationFailure
+from pymongo import monitoring
 import os
+import asyncio
+import base64
+import contextvars
+import csv
+import hashlib
+import io
+import json
 import logging
+import re
+import sys
+import threading
+import time
+from collections import deque, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from pydantic import BaseModel, Field, ConfigDict
-from typing import List, Optional, Dict
+from pydantic import BaseModel, Field, ConfigDict, TypeAdapter
+from typing import List, Optional, Dict, Tuple
 import uuid
-from datetime import datetime, timezone
+import numpy as np
+import httpx
+import orjson
+from pydantic_core import PydanticUndefined
+from datetime import datetime, timezone, timedelta, date
+from zoneinfo import ZoneInfo
+from PIL import Image, ImageOps
 from emergentintegrations.payments.stripe.checkout import (
     StripeCheckout,
     CheckoutSessionResponse,
@@ -19,13 +44,276 @@ from emergentintegrations.payments.stripe.checkout import (
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
+# ==================== METRICS ====================
+
+# Default latency buckets in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _label_str(labelnames: Tuple[str, ...], values: Tuple) -> str:
+    if not labelnames:
+        return ""
+    pairs = ",".join(f'{name}="{str(value)}"' for name, value in zip(labelnames, values))
+    return "{" + pairs + "}"
+
+class Metric:
+    """Minimal Prometheus metric; values are per process"""
+
+    def __init__(self, name: str, help_text: str, kind: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.kind = kind
+        self.labelnames = labelnames
+        self._values: Dict[Tuple, float] = {}
+        # Los listeners de pymongo se ejecutan en hilos del executor de Motor
+        self._lock = threading.Lock()
+
+    def inc(self, labels: Tuple = (), amount: float = 1.0):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def dec(self, labels: Tuple = (), amount: float = 1.0):
+        self.inc(labels, -amount)
+
+    def set(self, labels: Tuple = (), value: float = 0.0):
+        with self._lock:
+            self._values[labels] = value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_label_str(self.labelnames, labels)} {value:g}")
+        return lines
+
+class Histogram(Metric):
+    def __init__(self, name: str, help_text: str, labelnames: Tuple[str, ...] = (), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, "histogram", labelnames)
+        self.buckets = buckets
+        self._series: Dict[Tuple, List] = {}  # labels -> [bucket counts..., sum, count]
+
+    def observe(self, labels: Tuple, value: float):
+        with self._lock:
+            series = self._series.setdefault(labels, [0] * len(self.buckets) + [0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for labels, series in sorted(self._series.items()):
+                for bound, count in zip(self.buckets, series):
+                    le_labels = _label_str(self.labelnames + ("le",), labels + (f"{bound:g}",))
+                    lines.append(f"{self.name}_bucket{le_labels} {count}")
+                inf_labels = _label_str(self.labelnames + ("le",), labels + ("+Inf",))
+                lines.append(f"{self.name}_bucket{inf_labels} {series[-1]}")
+                lines.append(f"{self.name}_sum{_label_str(self.labelnames, labels)} {series[-2]:g}")
+                lines.append(f"{self.name}_count{_label_str(self.labelnames, labels)} {series[-1]}")
+        return lines
+
+HTTP_REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds", "HTTP request latency by route", ("method", "route"))
+HTTP_REQUESTS = Metric(
+    "http_requests_total", "HTTP responses by route and status code", "counter", ("method", "route", "status"))
+HTTP_IN_FLIGHT = Metric(
+    "http_requests_in_flight", "HTTP requests currently being served", "gauge", ("method", "route"))
+MONGO_COMMAND_DURATION = Histogram(
+    "mongo_command_duration_seconds", "MongoDB command latency by collection and command", ("collection", "command"))
+MONGO_COMMAND_FAILURES = Metric(
+    "mongo_command_failures_total", "Failed MongoDB commands", "counter", ("collection", "command"))
+STRIPE_CALL_DURATION = Histogram(
+    "stripe_call_duration_seconds", "Stripe checkout client call latency", ("operation", "outcome"))
+ADMISSION_REJECTIONS = Metric(
+    "admission_rejections_total", "Requests shed by admission control", "counter", ("gate", "reason"))
+# Read from the inbox collection when /metrics is scraped, so shared by all workers
+WEBHOOK_INBOX_EVENTS = Metric(
+    "webhook_inbox_events", "Stripe events in the webhook inbox by status", "gauge", ("status",))
+WEBHOOK_INBOX_OLDEST_SECONDS = Metric(
+    "webhook_inbox_oldest_pending_seconds", "Age of the oldest unprocessed Stripe event", "gauge")
+WEBHOOK_INBOX_LAG_SECONDS = Metric(
+    "webhook_inbox_last_batch_lag_seconds", "Receive-to-apply lag of this process's last batch", "gauge")
+
+METRICS = [
+    HTTP_REQUEST_DURATION, HTTP_REQUESTS, HTTP_IN_FLIGHT,
+    MONGO_COMMAND_DURATION, MONGO_COMMAND_FAILURES, STRIPE_CALL_DURATION, ADMISSION_REJECTIONS,
+    WEBHOOK_INBOX_EVENTS, WEBHOOK_INBOX_OLDEST_SECONDS, WEBHOOK_INBOX_LAG_SECONDS
+]
+
+def render_metrics() -> str:
+    lines = []
+    for metric in METRICS:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+class MongoMetricsListener(monitoring.CommandListener):
+    """Times every MongoDB command per collection and command name"""
+
+    def __init__(self):
+        self._collections: Dict[Tuple, str] = {}
+
+    def started(self, event):
+        target = event.command.get(event.command_name)
+        collection = target if isinstance(target, str) else "-"
+        self._collections[(event.connection_id, event.request_id)] = collection
+
+    def succeeded(self, event):
+        collection = self._collections.pop((event.connection_id, event.request_id), "-")
+        MONGO_COMMAND_DURATION.observe((collection, event.command_name), event.duration_micros / 1e6)
+
+    def failed(self, event):
+        collection = self._collections.pop((event.connection_id, event.request_id), "-")
+        MONGO_COMMAND_DURATION.observe((collection, event.command_name), event.duration_micros / 1e6)
+        MONGO_COMMAND_FAILURES.inc((collection, event.command_name))
+
+# ==================== MONGO PROFILER ====================
+
+# Commands slower than this are logged together with their explain plan
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', '100'))
+# Requests issuing at least this many commands are logged as chatty
+CHATTY_REQUEST_COMMANDS = int(os.environ.get('CHATTY_REQUEST_COMMANDS', '5'))
+# Always add the X-Mongo-* headers; otherwise only when the request sends X-Debug-Mongo
+MONGO_DEBUG_HEADERS = os.environ.get('MONGO_DEBUG_HEADERS', 'false').lower() == 'true'
+EXPLAINABLE_COMMANDS = {"find", "aggregate", "count", "distinct", "update", "delete", "findAndModify"}
+# Explain the same query shape at most once per this many seconds
+EXPLAIN_INTERVAL = 60.0
+
+MONGO_REQUEST_COMMANDS = Histogram(
+    "http_request_mongo_commands", "MongoDB round trips per HTTP request", ("method", "route"),
+    buckets=(1, 2, 3, 4, 5, 8, 13, 21))
+METRICS.append(MONGO_REQUEST_COMMANDS)
+
+class RequestProfile:
+    """MongoDB commands issued while serving one HTTP request"""
+
+    def __init__(self, label: str):
+        self.label = label
+        self.commands: List[Tuple[str, str, float]] = []  # (command, collection, ms)
+        self._lock = threading.Lock()
+
+    def record(self, command_name: str, collection: str, duration_ms: float):
+        with self._lock:
+            self.commands.append((command_name, collection, duration_ms))
+
+    @property
+    def total_ms(self) -> float:
+        return sum(ms for _, _, ms in self.commands)
+
+    def summary(self) -> str:
+        return ", ".join(f"{cmd}:{coll}" for cmd, coll, _ in self.commands)
+
+current_profile: contextvars.ContextVar[Optional[RequestProfile]] = contextvars.ContextVar("current_profile", default=None)
+
+def _command_shape(command_name: str, command: Dict) -> Tuple:
+    query = command.get("filter") or command.get("query") or {}
+    if command_name == "aggregate":
+        query = {stage_name: 1 for stage in command.get("pipeline", []) for stage_name in stage}
+    elif command_name in ("update", "delete"):
+        statements = command.get("updates") or command.get("deletes") or [{}]
+        query = statements[0].get("q", {})
+    return (command_name, command.get(command_name), tuple(sorted(query)))
+
+class MongoProfiler(monitoring.CommandListener):
+    """Tags MongoDB commands with the current request and explains slow ones"""
+
+    def __init__(self):
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self._started: Dict[Tuple, Tuple] = {}
+        self._explained: Dict[Tuple, float] = {}
+
+    def started(self, event):
+        # Motor copia los contextvars al hilo que ejecuta el comando
+        profile = current_profile.get()
+        if profile is None and event.command_name not in EXPLAINABLE_COMMANDS:
+            return
+        self._started[(event.connection_id, event.request_id)] = (profile, event.command, event.database_name)
+
+    def succeeded(self, event):
+        self._finish(event)
+
+    def failed(self, event):
+        self._finish(event)
+
+    def _finish(self, event):
+        started = self._started.pop((event.connection_id, event.request_id), None)
+        if started is None:
+            return
+        profile, command, database_name = started
+        target = command.get(event.command_name)
+        collection = target if isinstance(target, str) else "-"
+        duration_ms = event.duration_micros / 1000
+        if profile is not None:
+            profile.record(event.command_name, collection, duration_ms)
+        if duration_ms >= SLOW_QUERY_MS and event.command_name in EXPLAINABLE_COMMANDS:
+            self._schedule_explain(profile, command, database_name, event.command_name, duration_ms)
+
+    def _schedule_explain(self, profile, command, database_name, command_name, duration_ms):
+        shape = _command_shape(command_name, command)
+        now = time.monotonic()
+        if now - self._explained.get(shape, -EXPLAIN_INTERVAL) < EXPLAIN_INTERVAL or self.loop is None:
+            return
+        self._explained[shape] = now
+        # Quitar los campos de sesión/cluster que el driver añade al comando
+        explainable = {k: v for k, v in command.items() if not k.startswith("$") and k not in ("lsid", "txnNumber")}
+        label = profile.label if profile else "background"
+        self.loop.call_soon_threadsafe(
+            asyncio.ensure_future,
+            self._log_slow(label, database_name, explainable, command_name, duration_ms)
+        )
+
+    async def _log_slow(self, label, database_name, command, command_name, duration_ms):
+        try:
+            explain = await client[database_name].command({"explain": command, "verbosity": "queryPlanner"})
+            winning = explain.get("queryPlanner", {}).get("winningPlan", {})
+            plan = json.dumps(winning, default=str)
+        except Exception as e:
+            plan = f"explain failed: {e}"
+        logger.warning(f"Slow query {duration_ms:.1f}ms [{label}] {command_name} {command.get(command_name)}: {plan}")
+
+mongo_profiler = MongoProfiler()
+
+# Outbound Stripe calls in flight. Motor has its own thread pool, so this only
+# shapes traffic to Stripe: the shared httpx pool keeps 20 keep-alive connections,
+# and 20 calls of about a second stay under Stripe's rate limit (25 requests/s
+# in test mode, 100 live) instead of turning a burst into 429s from Stripe
+STRIPE_CONCURRENCY = int(os.environ.get('STRIPE_CONCURRENCY', '20'))
+# Seconds a Stripe call waits for a free slot before the request gets a 503
+STRIPE_QUEUE_TIMEOUT = float(os.environ.get('STRIPE_QUEUE_TIMEOUT', '5'))
+stripe_slots = asyncio.Semaphore(STRIPE_CONCURRENCY)
+
+async def stripe_call(operation: str, awaitable, limit: bool = True):
+    """Await a Stripe checkout client call, recording its latency"""
+    if limit:
+        try:
+            await asyncio.wait_for(stripe_slots.acquire(), STRIPE_QUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            awaitable.close()
+            ADMISSION_REJECTIONS.inc(("stripe", "timeout"))
+            raise HTTPException(status_code=503, detail="Payment provider busy, try again",
+                                headers={"Retry-After": "2"})
+    start = time.perf_counter()
+    outcome = "error"
+    try:
+        result = await awaitable
+        outcome = "ok"
+        return result
+    finally:
+        STRIPE_CALL_DURATION.observe((operation, outcome), time.perf_counter() - start)
+        if limit:
+            stripe_slots.release()
+
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+# tz_aware: fechas BSON nativas se leen como datetimes UTC
+client = AsyncIOMotorClient(mongo_url, tz_aware=True, event_listeners=[MongoMetricsListener(), mongo_profiler])
 db = client[os.environ['DB_NAME']]
 
+# Opt-in fast path: orjson encoding and no re-validation of trusted database reads
+FAST_RESPONSES = os.environ.get('FAST_RESPONSES', 'false').lower() == 'true'
+
 # Create the main app
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse if FAST_RESPONSES else JSONResponse)
 
 # Create router with /api prefix
 api_router = APIRouter(prefix="/api")
@@ -43,6 +331,11 @@ class Ingredient(BaseModel):
     unit_cost: float
     total_cost: float
 
+class ImageVariant(BaseModel):
+    width: int
+    format: str  # webp, jpeg
+    url: str
+
 class Product(BaseModel):
     model_config = ConfigDict(extra="ignore")
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -55,6 +348,8 @@ class Product(BaseModel):
     food_cost: float = 0.0
     tax_rate: float = 0.10
     is_available: bool = True
+    unavailable_reason: Optional[str] = None  # "stock" when switched off by the stock ledger
+    image_variants: List[ImageVariant] = []  # resized copies of image_url, smallest first
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
 class ProductCreate(BaseModel):
@@ -65,6 +360,7 @@ class ProductCreate(BaseModel):
     image_url: str
     ingredients: List[Ingredient] = []
     food_cost: float = 0.0
+    tax_rate: float = 0.10
     is_available: bool = True
 
 class ProductUpdate(BaseModel):
@@ -75,13 +371,15 @@ class ProductUpdate(BaseModel):
     image_url: Optional[str] = None
     ingredients: Optional[List[Ingredient]] = None
     food_cost: Optional[float] = None
+    tax_rate: Optional[float] = None
     is_available: Optional[bool] = None
 
 class CartItem(BaseModel):
     product_id: str
     quantity: int
     product_name: str
-    price: float
+    price: float  # re-priced server side on order creation
+    tax_rate: Optional[float] = None
 
 class OrderCreate(BaseModel):
     items: List[CartItem]
@@ -100,11 +398,19 @@ class Order(BaseModel):
     customer_phone: str
     pickup_time: str
     notes: str = ""
+    subtotal: float = 0.0  # total without tax
+    tax: float = 0.0
+    tax_breakdown: Dict[str, float] = {}  # tax amount per rate
     total: float
     status: str = "pending"  # pending, paid, preparing, ready, completed, cancelled
     payment_method: Optional[str] = None
     payment_session_id: Optional[str] = None
+    pickup_slot: Optional[str] = None  # reserved slot key, YYYY-MM-DDTHH:MM
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    status_updated_at: Optional[datetime] = None
+    status_timestamps: Dict[str, datetime] = {}  # when the order entered each status
+    cancel_reason: Optional[str] = None  # "expired" when the pending sweep cancelled it
+    paid_after_cancel: bool = False  # checkout paid after cancelling, needs a refund
 
 class PaymentTransaction(BaseModel):
     model_config = ConfigDict(extra="ignore")
@@ -127,6 +433,77 @@ class CheckoutRequest(BaseModel):
     origin_url: str
     payment_method: str = "stripe"  # stripe or paypal
 
+class CatalogIngredient(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    name: str
+    unit: str  # g, ml, ud
+    unit_cost: float  # cost per unit
+    updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+class IngredientCreate(BaseModel):
+    name: str
+    unit: str
+    unit_cost: float = Field(ge=0)
+
+class IngredientPriceUpdate(BaseModel):
+    unit_cost: float = Field(ge=0)
+
+class StockLevel(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    name: str
+    unit: str
+    quantity: float
+    updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+class StockAdjustment(BaseModel):
+    quantity: Optional[float] = None  # set the level (stock count)
+    delta: Optional[float] = None  # or add to it (delivery, waste)
+    unit: Optional[str] = None
+
+# Upper bound on items per bulk admin request
+BULK_MAX_ITEMS = 1000
+
+class ProductPatch(BaseModel):
+    product_id: str
+    is_available: Optional[bool] = None
+    price: Optional[float] = Field(default=None, gt=0)
+
+class BulkProductUpdate(BaseModel):
+    updates: List[ProductPatch] = Field(..., min_length=1, max_length=BULK_MAX_ITEMS)
+
+class OrderStatusChange(BaseModel):
+    order_id: str
+    status: str
+
+class BulkOrderStatusUpdate(BaseModel):
+    updates: List[OrderStatusChange] = Field(..., min_length=1, max_length=BULK_MAX_ITEMS)
+
+# ==================== FAST SERIALIZATION ====================
+
+class TrustedDump:
+    """Precompiled projection of trusted database documents onto a model's fields.
+
+    Documents written through the models are already valid, so reads only need
+    the response shape (model fields, defaults for fields added later) rather
+    than a full validate-and-serialize round through pydantic.
+    """
+
+    def __init__(self, model):
+        self.defaults = {}
+        for name, field in model.model_fields.items():
+            default = field.get_default(call_default_factory=False)
+            self.defaults[name] = None if default is PydanticUndefined else default
+
+    def one(self, doc: Dict) -> Dict:
+        return {name: doc.get(name, default) for name, default in self.defaults.items()}
+
+    def many(self, docs: List[Dict]) -> List[Dict]:
+        return [self.one(doc) for doc in docs]
+
+product_dump = TrustedDump(Product)
+order_dump = TrustedDump(Order)
+
 # ==================== INITIAL PRODUCTS (Escandallos) ====================
 
 INITIAL_PRODUCTS = [
@@ -267,7 +644,129 @@ INITIAL_PRODUCTS = [
     }
 ]
 
-# ==================== STARTUP EVENT ====================
+# ==================== DATABASE INDEXES ====================
+
+# Processed Stripe events, raw payload included, are deleted after this many days
+WEBHOOK_RETENTION_DAYS = float(os.environ.get('WEBHOOK_RETENTION_DAYS', '30'))
+
+# (collection, keys, options). The name is part of the spec so that a changed
+# definition is detected and rebuilt on the next startup.
+REQUIRED_INDEXES = [
+    ("products", [("id", 1)], {"name": "id_unique", "unique": True}),
+    ("products", [("category", 1), ("is_available", 1)], {"name": "category_available"}),
+    ("products", [("ingredients.name", 1)], {"name": "ingredient_name"}),
+    ("ingredients", [("id", 1)], {"name": "id_unique", "unique": True}),
+    ("daily_sales", [("day", 1), ("product_id", 1)], {"name": "day_product"}),
+    ("pickup_slots", [("day", 1), ("time", 1)], {"name": "day_time"}),
+    ("stock", [("name", 1)], {"name": "name_unique", "unique": True}),
+    ("stock_movements", [("order_id", 1)], {"name": "order_id"}),
+    ("ingredients", [("name", 1)], {"name": "name_unique", "unique": True}),
+    ("orders", [("id", 1)], {"name": "id_unique", "unique": True}),
+    ("orders", [("status", 1), ("created_at", -1), ("id", -1)], {"name": "status_created_at"}),
+    ("orders", [("created_at", -1), ("id", -1)], {"name": "created_at"}),
+    ("orders", [("payment_session_id", 1)], {"name": "payment_session_id", "sparse": True}),
+    ("payment_transactions", [("session_id", 1)], {"name": "session_id_unique", "unique": True}),
+    ("payment_transactions", [("created_at", 1)], {"name": "created_at"}),
+    ("webhook_inbox", [("event_id", 1)], {"name": "event_id_unique", "unique": True}),
+    ("webhook_inbox", [("status", 1), ("received_at", 1)], {"name": "status_received_at"}),
+    # TTL: solo los eventos ya aplicados; los fallidos se quedan para revisarlos
+    ("webhook_inbox", [("processed_at", 1)], {
+        "name": "processed_at_ttl",
+        "expireAfterSeconds": int(WEBHOOK_RETENTION_DAYS * 86400),
+        "partialFilterExpression": {"status": "done"}
+    }),
+]
+
+# Query shapes issued by the endpoints, used by the index report to flag COLLSCANs
+QUERY_SHAPES = [
+    ("products", {"id": "x"}, None),
+    ("products", {"category": "bowls", "is_available": True}, None),
+    ("orders", {"id": "x"}, None),
+    ("orders", {}, [("created_at", -1), ("id", -1)]),
+    ("orders", {"status": "pending"}, [("created_at", -1), ("id", -1)]),
+    ("orders", {"payment_session_id": "x"}, None),
+    ("payment_transactions", {"session_id": "x"}, None),
+    # Expiración de pedidos pendientes
+    ("orders", {"status": "pending", "created_at": {"$lt": datetime(2000, 1, 1, tzinfo=timezone.utc)}}, None),
+    # Reclamo de eventos del webhook inbox
+    ("webhook_inbox", {"$or": [
+        {"status": "pending"},
+        {"status": "processing", "claimed_at": {"$lt": datetime(2000, 1, 1, tzinfo=timezone.utc)}}
+    ]}, [("received_at", 1)]),
+    ("webhook_inbox", {"event_id": "x"}, None),
+    ("pickup_slots", {"day": "2000-01-01"}, None),
+    ("products", {"ingredients.name": {"$in": ["x"]}}, None),
+    ("ingredients", {"name": "x"}, None),
+    ("stock", {"name": {"$in": ["x"]}}, None),
+    ("daily_sales", {"day": {"$gte": "2000-01-01", "$lte": "2000-01-31"}}, None),
+]
+
+def _index_matches(existing: Dict, keys: List, options: Dict) -> bool:
+    if list(existing.get("key", [])) != [tuple(k) for k in keys]:
+        return False
+    return all(existing.get(opt, False) == value for opt, value in options.items() if opt != "name")
+
+async def ensure_indexes() -> bool:
+    """Create missing indexes and rebuild the ones whose definition changed"""
+    complete = True
+    # Una lectura de index_information por colección, todas a la vez: barato cuando no falta nada
+    collection_names = sorted({c for c, _, _ in REQUIRED_INDEXES})
+    indexes = dict(zip(collection_names, await asyncio.gather(
+        *(db[collection_name].index_information() for collection_name in collection_names)
+    )))
+    for collection_name, keys, options in REQUIRED_INDEXES:
+        collection = db[collection_name]
+        existing = indexes[collection_name].get(options["name"])
+        if existing and _index_matches(existing, keys, options):
+            continue
+        try:
+            if existing:
+                logger.info(f"Rebuilding index {collection_name}.{options['name']}")
+                await collection.drop_index(options["name"])
+            await collection.create_index(keys, **options)
+        except Exception as e:
+            # Un índice que no se puede crear (p.ej. duplicados) no debe tumbar el arranque
+            logger.error(f"Could not create index {collection_name}.{options['name']}: {e}")
+            complete = False
+    return complete
+
+def _plan_stages(plan: Dict) -> List[str]:
+    stages = [plan.get("stage", "")]
+    for child_key in ("inputStage", "queryPlan"):
+        if child_key in plan:
+            stages += _plan_stages(plan[child_key])
+    for child in plan.get("inputStages", []):
+        stages += _plan_stages(child)
+    return stages
+
+async def index_report() -> Dict:
+    """Index usage counters plus the winning plan of every known query shape"""
+    usage = {}
+    for collection_name in sorted({c for c, _, _ in REQUIRED_INDEXES}):
+        stats = await db[collection_name].aggregate([{"$indexStats": {}}]).to_list(None)
+        usage[collection_name] = [
+            {"name": s["name"], "ops": s["accesses"]["ops"], "since": s["accesses"]["since"].isoformat()}
+            for s in stats
+        ]
+
+    queries = []
+    for collection_name, query, sort in QUERY_SHAPES:
+        cursor = db[collection_name].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        explain = await cursor.explain()
+        stages = _plan_stages(explain.get("queryPlanner", {}).get("winningPlan", {}))
+        queries.append({
+            "collection": collection_name,
+            "filter": list(query.keys()),
+            "sort": [k for k, _ in sort] if sort else [],
+            "stages": stages,
+            "collscan": "COLLSCAN" in stages
+        })
+
+    return {"index_usage": usage, "queries": queries}
+
+# ==================== SEED & MIGRATIONS ====================
 
 # IDs fijos para productos iniciales (para que no se borren)
 INITIAL_PRODUCT_IDS = [
@@ -282,45 +781,334 @@ INITIAL_PRODUCT_IDS = [
     "prod-mediterraneo-009"
 ]
 
+def json_default(value):
+    """json.dumps fallback for Mongo values: ISO 8601 datetimes, str() for the rest"""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+def spec_version(spec) -> str:
+    """Stable short hash of a seed or schema definition"""
+    encoded = json.dumps(spec, sort_keys=True, ensure_ascii=False, default=json_default)
+    return hashlib.sha256(encoded.encode()).hexdigest()[:16]
+
+SEED_VERSION = spec_version([INITIAL_PRODUCT_IDS, INITIAL_PRODUCTS])
+
+async def apply_seed() -> bool:
+    """Upsert every missing initial product in a single unordered bulk write"""
+    ops = []
+    for fixed_id, product_data in zip(INITIAL_PRODUCT_IDS, INITIAL_PRODUCTS):
+        doc = Product(**{**product_data, "id": fixed_id}).model_dump()
+        # $setOnInsert: nunca pisar cambios hechos desde el panel de admin
+        ops.append(UpdateOne({"id": fixed_id}, {"$setOnInsert": doc}, upsert=True))
+
+    result = await db.products.bulk_write(ops, ordered=False)
+    logger.info(f"Seed applied: {result.upserted_count} products added")
+    if result.upserted_count:
+        invalidate_product_caches()
+    return True
+
+async def build_ingredient_catalog() -> bool:
+    """Create catalog entries for every ingredient used in an escandallo"""
+    products = await db.products.find({}, {"_id": 0, "ingredients": 1}).to_list(None)
+    ops = []
+    seen = set()
+    for product in products:
+        for line in product.get("ingredients", []):
+            if line["name"] in seen or not line.get("quantity"):
+                continue
+            seen.add(line["name"])
+            ingredient = CatalogIngredient(
+                name=line["name"],
+                unit=line["unit"],
+                unit_cost=round(line["total_cost"] / line["quantity"], 6)
+            )
+            ops.append(UpdateOne({"name": ingredient.name}, {"$setOnInsert": ingredient.model_dump()}, upsert=True))
+    if ops:
+        result = await db.ingredients.bulk_write(ops, ordered=False)
+        logger.info(f"Ingredient catalog: {result.upserted_count} ingredients added")
+    return True
+
+# Date fields that older versions stored as ISO strings
+DATE_FIELDS = {
+    "products": ["created_at"],
+    "orders": ["created_at"],
+    "payment_transactions": ["created_at"],
+}
+DATE_MIGRATION_BATCH_SIZE = 500
+
+async def migrate_native_dates() -> bool:
+    """Convert ISO-string dates to native BSON dates in place, one batch at a time"""
+    for collection_name, fields in DATE_FIELDS.items():
+        collection = db[collection_name]
+        for field in fields:
+            converted = 0
+            last_id = None
+            while True:
+                query = {field: {"$type": "string"}}
+                if last_id is not None:
+                    query["_id"] = {"$gt": last_id}
+                batch = await collection.find(query, {field: 1}) \
+                    .sort("_id", 1).limit(DATE_MIGRATION_BATCH_SIZE).to_list(DATE_MIGRATION_BATCH_SIZE)
+                if not batch:
+                    break
+                last_id = batch[-1]["_id"]
+
+                # El valor antiguo en el filtro hace la conversión idempotente entre workers
+                ops = [
+                    UpdateOne({"_id": doc["_id"], field: doc[field]}, {"$set": {field: as_utc(datetime.fromisoformat(doc[field]))}})
+                    for doc in batch
+                ]
+                result = await collection.bulk_write(ops, ordered=False)
+                converted += result.modified_count
+                await asyncio.sleep(0)
+            if converted:
+                logger.info(f"Converted {converted} {collection_name}.{field} values to native dates")
+    return True
+
+async def invalidate_order_stats() -> bool:
+    """Mark the materialized order stats for a rebuild on the next dashboard read"""
+    await db.stats.update_one({"_id": "orders"}, {"$set": {"stale": True}})
+    return True
+
+# (name, version, step, background). A step whose recorded version matches is
+# skipped; a step returning False is retried on the next boot. Background steps
+# do not hold up startup.
+MIGRATIONS = [
+    ("seed", SEED_VERSION, apply_seed, False),
+    ("ingredient_catalog", "1", build_ingredient_catalog, False),
+    ("native_dates", "1", migrate_native_dates, True),
+    # Revenue now counts every sold status (SOLD_STATUSES)
+    ("order_stats", "2", invalidate_order_stats, False),
+]
+
+migration_tasks: Dict[str, asyncio.Task] = {}
+
+async def _run_migration(name: str, version: str, step):
+    try:
+        if await step():
+            await db.meta.update_one({"_id": "migrations"}, {"$set": {name: version}}, upsert=True)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.error(f"Migration {name} failed: {e}")
+
+async def wait_for_migration(name: str):
+    """Wait for a background migration started by this process, if it is still running"""
+    task = migration_tasks.get(name)
+    if task is not None and not task.done():
+        await asyncio.shield(task)
+
+async def run_migrations(force: bool = False, wait: bool = False):
+    """Reconcile indexes, then apply pending migrations and record their versions in the meta collection"""
+    # Siempre: un índice borrado o perdido se recrea en el siguiente arranque
+    await ensure_indexes()
+    applied = await db.meta.find_one({"_id": "migrations"}) or {}
+    for name, version, step, background in MIGRATIONS:
+        if applied.get(name) == version and not force:
+            continue
+        logger.info(f"Running migration {name} ({applied.get(name)} -> {version})")
+        if background and not wait:
+            migration_tasks[name] = asyncio.ensure_future(_run_migration(name, version, step))
+        else:
+            await _run_migration(name, version, step)
+
+# ==================== STARTUP EVENT ====================
+
 @app.on_event("startup")
 async def startup_event():
-    """Initialize products - ensures all initial products exist"""
-    logger.info("Checking products database...")
+    """Reconcile indexes and apply pending seed migrations - cheap when up to date"""
+    mongo_profiler.loop = asyncio.get_running_loop()
+    await run_migrations()
+    logger.info("Database ready")
+    payments.start()
+    webhook_inbox.start()
+    global order_feed_uses_change_stream, pending_sweep_task
+    pending_sweep_task = asyncio.create_task(sweep_pending_orders())
+    order_feed_uses_change_stream = await detect_change_streams()
+    logger.info(f"Order feed: {'change stream' if order_feed_uses_change_stream else 'in-process bus'}")
+    if not ADMISSION_PER_CLIENT:
+        logger.warning("Per-client rate limits are off: set TRUSTED_PROXY_HOPS behind a proxy, "
+                       "or ADMISSION_PER_CLIENT=1 when clients connect directly")
+
+# ==================== MENU CACHE ====================
+
+# Seconds a snapshot may be served before it is rebuilt. Invalidation only
+# reaches the worker that handled the write, so other workers converge here.
+MENU_CACHE_TTL = float(os.environ.get('MENU_CACHE_TTL', '60'))
+# Snapshots kept at most (one per category / available_only combination)
+MENU_CACHE_MAX_ENTRIES = int(os.environ.get('MENU_CACHE_MAX_ENTRIES', '32'))
+
+product_list_adapter = TypeAdapter(List[Product])
+
+class MenuCache:
+    """Versioned, pre-encoded snapshots of GET /api/products per filter combination"""
+
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.version = 0
+        # Oldest first; the category comes from the query string, so the size is capped
+        self._entries: "OrderedDict[Tuple[Optional[str], bool], Tuple[int, float, bytes, str]]" = OrderedDict()
+        self._lock = asyncio.Lock()
+
+    def invalidate(self):
+        self.version += 1
+        self._entries.clear()
+
+    def _fresh(self, key) -> Optional[Tuple[bytes, str]]:
+        entry = self._entries.get(key)
+        if entry and entry[0] == self.version and time.monotonic() - entry[1] < self.ttl:
+            return entry[2], entry[3]
+        return None
+
+    async def get(self, category: Optional[str], available_only: bool) -> Tuple[bytes, str]:
+        key = (category, available_only)
+        cached = self._fresh(key)
+        if cached:
+            return cached
+
+        # Un solo rebuild a la vez: el resto espera y reutiliza el snapshot
+        async with self._lock:
+            cached = self._fresh(key)
+            if cached:
+                return cached
+
+            version = self.version
+            query = {}
+            if category:
+                query["category"] = category
+            if available_only:
+                query["is_available"] = True
+
+            products = await db.products.find(query, {"_id": 0}).to_list(100)
+            if FAST_RESPONSES:
+                body = orjson.dumps(product_dump.many(products))
+            else:
+                body = product_list_adapter.dump_json(product_list_adapter.validate_python(products))
+            etag = '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+
+            # Si hubo una escritura durante la consulta no guardamos un snapshot viejo
+            if version == self.version:
+                self._store(key, (version, time.monotonic(), body, etag))
+            return body, etag
+
+    def _store(self, key, entry):
+        self._entries.pop(key, None)
+        now = time.monotonic()
+        while self._entries:
+            oldest_key, oldest = next(iter(self._entries.items()))
+            if now - oldest[1] < self.ttl and len(self._entries) < self.max_entries:
+                break
+            # Caducada o sobra: las entradas van en orden de creación
+            del self._entries[oldest_key]
+        self._entries[key] = entry
+
+menu_cache = MenuCache(MENU_CACHE_TTL, MENU_CACHE_MAX_ENTRIES)
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Check an If-None-Match header against a strong ETag"""
+    if not if_none_match:
+        return False
+    candidates = [c.strip() for c in if_none_match.split(',')]
+    return "*" in candidates or etag in candidates
+
+# ==================== PRODUCT PRICE INDEX ====================
+
+PRICE_INDEX_TTL = float(os.environ.get('PRICE_INDEX_TTL', '60'))
+PRICE_INDEX_FIELDS = {"_id": 0, "id": 1, "name": 1, "price": 1, "tax_rate": 1, "is_available": 1}
+
+class ProductPriceIndex:
+    """In-memory product_id -> price/availability map used to price orders"""
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._products: Dict[str, Dict] = {}
+        self._loaded_at: Optional[float] = None
+        self._lock = asyncio.Lock()
+
+    def invalidate(self):
+        self._products = {}
+        self._loaded_at = None
+
+    async def _ensure_loaded(self):
+        if self._loaded_at is not None and time.monotonic() - self._loaded_at < self.ttl:
+            return
+        async with self._lock:
+            if self._loaded_at is not None and time.monotonic() - self._loaded_at < self.ttl:
+                return
+            products = await db.products.find({}, PRICE_INDEX_FIELDS).to_list(None)
+            self._products = {p["id"]: p for p in products}
+            self._loaded_at = time.monotonic()
+
+    async def lookup(self, product_ids: List[str]) -> Dict[str, Dict]:
+        """Products by id; ids missing from the index are fetched with a single $in query"""
+        await self._ensure_loaded()
+        missing = [pid for pid in set(product_ids) if pid not in self._products]
+        if missing:
+            fetched = await db.products.find({"id": {"$in": missing}}, PRICE_INDEX_FIELDS).to_list(None)
+            for p in fetched:
+                self._products[p["id"]] = p
+        return {pid: self._products[pid] for pid in product_ids if pid in self._products}
+
+product_price_index = ProductPriceIndex(PRICE_INDEX_TTL)
+
+def invalidate_product_caches():
+    menu_cache.invalidate()
+    product_price_index.invalidate()
+
+async def price_order_items(items: List[CartItem]) -> Tuple[List[CartItem], Dict]:
+    """Validate cart items against the catalog and re-price them; prices include tax"""
+    if not items:
+        raise HTTPException(status_code=400, detail="Order has no items")
+    
+    products = await product_price_index.lookup([item.product_id for item in items])
     
-    # Verificar cada producto inicial y añadirlo si falta
-    for idx, product_data in enumerate(INITIAL_PRODUCTS):
-        fixed_id = INITIAL_PRODUCT_IDS[idx]
-        existing = await db.products.find_one({"id": fixed_id})
+    priced = []
+    total = subtotal = 0.0
+    tax_breakdown: Dict[str, float] = {}
+    for item in items:
+        product = products.get(item.product_id)
+        if not product:
+            raise HTTPException(status_code=400, detail=f"Unknown product: {item.product_id}")
+        if not product.get("is_available", True):
+            raise HTTPException(status_code=400, detail=f"Product not available: {product['name']}")
+        if item.quantity < 1:
+            raise HTTPException(status_code=400, detail=f"Invalid quantity for {product['name']}")
         
-        if not existing:
-            logger.info(f"Adding missing product: {product_data['name']}")
-            product_data_copy = product_data.copy()
-            product_data_copy['id'] = fixed_id
-            product = Product(**product_data_copy)
-            doc = product.model_dump()
-            doc['id'] = fixed_id  # Asegurar ID fijo
-            doc['created_at'] = doc['created_at'].isoformat()
-            await db.products.insert_one(doc)
-    
-    count = await db.products.count_documents({})
-    logger.info(f"Products database ready: {count} products")
+        tax_rate = product.get("tax_rate", 0.10)
+        line_total = product["price"] * item.quantity
+        line_base = line_total / (1 + tax_rate)
+        total += line_total
+        subtotal += line_base
+        rate_key = f"{tax_rate:.2f}"
+        tax_breakdown[rate_key] = tax_breakdown.get(rate_key, 0.0) + line_total - line_base
+        
+        priced.append(CartItem(
+            product_id=item.product_id,
+            quantity=item.quantity,
+            product_name=product["name"],
+            price=product["price"],
+            tax_rate=tax_rate
+        ))
+    
+    return priced, {
+        "subtotal": round(subtotal, 2),
+        "tax": round(total - subtotal, 2),
+        "tax_breakdown": {rate: round(amount, 2) for rate, amount in tax_breakdown.items()},
+        "total": round(total, 2)
+    }
 
 # ==================== PRODUCT ENDPOINTS ====================
 
 @api_router.get("/products", response_model=List[Product])
-async def get_products(category: Optional[str] = None, available_only: bool = True):
+async def get_products(request: Request, category: Optional[str] = None, available_only: bool = True):
     """Get all products, optionally filtered by category"""
-    query = {}
-    if category:
-        query["category"] = category
-    if available_only:
-        query["is_available"] = True
-    
-    products = await db.products.find(query, {"_id": 0}).to_list(100)
-    for p in products:
-        if isinstance(p.get('created_at'), str):
-            p['created_at'] = datetime.fromisoformat(p['created_at'])
-    return products
+    body, etag = await menu_cache.get(category, available_only)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(request.headers.get("If-None-Match"), etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
 
 @api_router.get("/products/{product_id}", response_model=Product)
 async def get_product(product_id: str):
@@ -328,8 +1116,8 @@ async def get_product(product_id: str):
     product = await db.products.find_one({"id": product_id}, {"_id": 0})
     if not product:
         raise HTTPException(status_code=404, detail="Product not found")
-    if isinstance(product.get('created_at'), str):
-        product['created_at'] = datetime.fromisoformat(product['created_at'])
+    if FAST_RESPONSES:
+        return ORJSONResponse(product_dump.one(product))
     return product
 
 @api_router.post("/products", response_model=Product)
@@ -337,24 +1125,34 @@ async def create_product(product_data: ProductCreate):
     """Create a new product (admin only)"""
     product = Product(**product_data.model_dump())
     doc = product.model_dump()
-    doc['created_at'] = doc['created_at'].isoformat()
     await db.products.insert_one(doc)
+    invalidate_product_caches()
     return product
 
 @api_router.put("/products/{product_id}", response_model=Product)
 async def update_product(product_id: str, product_update: ProductUpdate):
     """Update a product (admin only)"""
-    existing = await db.products.find_one({"id": product_id})
-    if not existing:
-        raise HTTPException(status_code=404, detail="Product not found")
+    update_data = product_update.model_dump(exclude_none=True)
+    if "is_available" in update_data:
+        # Un cambio manual sustituye al apagado automático por stock
+        update_data["unavailable_reason"] = None
+    if "image_url" in update_data:
+        # Las variantes eran de la imagen anterior
+        update_data["image_variants"] = []
     
-    update_data = {k: v for k, v in product_update.model_dump().items() if v is not None}
     if update_data:
-        await db.products.update_one({"id": product_id}, {"$set": update_data})
-    
-    updated = await db.products.find_one({"id": product_id}, {"_id": 0})
-    if isinstance(updated.get('created_at'), str):
-        updated['created_at'] = datetime.fromisoformat(updated['created_at'])
+        updated = await db.products.find_one_and_update(
+            {"id": product_id},
+            {"$set": update_data},
+            projection={"_id": 0},
+            return_document=ReturnDocument.AFTER
+        )
+    else:
+        updated = await db.products.find_one({"id": product_id}, {"_id": 0})
+    if not updated:
+        raise HTTPException(status_code=404, detail="Product not found")
+    if update_data:
+        invalidate_product_caches()
     return updated
 
 @api_router.delete("/products/{product_id}")
@@ -363,42 +1161,1179 @@ async def delete_product(product_id: str):
     result = await db.products.delete_one({"id": product_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Product not found")
+    invalidate_product_caches()
     return {"message": "Product deleted successfully"}
 
+@api_router.post("/products/bulk")
+async def bulk_update_products(bulk: BulkProductUpdate):
+    """Apply availability and price patches to many products with one bulk write (admin only)"""
+    outcomes: List[Optional[str]] = []  # per item; None until the bulk write decides
+    patches = {}
+    for patch in bulk.updates:
+        fields = patch.model_dump(exclude={"product_id"}, exclude_none=True)
+        if patch.product_id in patches:
+            outcomes.append("duplicate")
+        elif not fields:
+            outcomes.append("no_changes")
+        else:
+            if "is_available" in fields:
+                # Un cambio manual sustituye al apagado automático por stock
+                fields["unavailable_reason"] = None
+            patches[patch.product_id] = fields
+            outcomes.append(None)
+
+    existing = set()
+    if patches:
+        existing = set(await db.products.distinct("id", {"id": {"$in": list(patches)}}))
+        ops = [UpdateOne({"id": pid}, {"$set": fields}) for pid, fields in patches.items() if pid in existing]
+        if ops:
+            await db.products.bulk_write(ops, ordered=False)
+            invalidate_product_caches()
+
+    results = [
+        {"product_id": patch.product_id,
+         "result": outcome or ("updated" if patch.product_id in existing else "not_found")}
+        for patch, outcome in zip(bulk.updates, outcomes)
+    ]
+    return {"updated": sum(r["result"] == "updated" for r in results), "results": results}
+
+# ==================== PRODUCT IMAGES ====================
+
+# Variants live in IMAGE_DIR/<sha256 of the source>/<width>.<ext>, so a path never changes content
+IMAGE_DIR = Path(os.environ.get('IMAGE_DIR', ROOT_DIR / 'images'))
+# file:// image URLs are only read from here (offline seeding and tests)
+IMAGE_SOURCE_DIR = Path(os.environ.get('IMAGE_SOURCE_DIR', ROOT_DIR / 'image_sources'))
+IMAGE_WIDTHS = tuple(int(w) for w in os.environ.get('IMAGE_WIDTHS', '320,640,960').split(','))
+IMAGE_MAX_BYTES = int(os.environ.get('IMAGE_MAX_BYTES', str(10 * 1024 * 1024)))
+IMAGE_WORKERS = int(os.environ.get('IMAGE_WORKERS', '2'))
+# Hosts product images may be fetched from (https only), e.g. "images.unsplash.com,cdn.example.com"
+IMAGE_ALLOWED_HOSTS = {h.strip().lower() for h in os.environ.get('IMAGE_ALLOWED_HOSTS', 'images.unsplash.com').split(',') if h.strip()}
+IMAGE_MAX_REDIRECTS = 3
+IMAGE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+IMAGE_FORMATS = {"webp": ("WEBP", "image/webp"), "jpg": ("JPEG", "image/jpeg")}
+IMAGE_NAME = re.compile(r"^[0-9a-f]{64}/\d+\.(webp|jpg)$")
+
+image_pool: Optional[ProcessPoolExecutor] = None
+
+def render_image_variants(source: bytes, digest: str, widths: Tuple[int, ...], image_dir: str) -> List[Dict]:
+    """Resize one source image into every width and format; runs in the image process pool"""
+    directory = Path(image_dir) / digest
+    directory.mkdir(parents=True, exist_ok=True)
+    variants = []
+    with Image.open(io.BytesIO(source)) as original:
+        image = ImageOps.exif_transpose(original).convert("RGB")
+    # Nunca ampliar: las anchuras mayores que el original se quedan en la del original
+    for width in sorted({min(w, image.width) for w in widths}):
+        resized = image.resize((width, max(1, round(image.height * width / image.width))), Image.LANCZOS)
+        for ext, (pil_format, _) in IMAGE_FORMATS.items():
+            path = directory / f"{width}.{ext}"
+            if not path.exists():
+                tmp = path.with_suffix(f".{ext}.tmp")
+                resized.save(tmp, pil_format, quality=80, optimize=True,
+                             **({"method": 6} if pil_format == "WEBP" else {"progressive": True}))
+                os.replace(tmp, path)
+            variants.append({
+                "width": width,
+                "format": "jpeg" if ext == "jpg" else ext,
+                "url": f"/api/images/{digest}/{width}.{ext}"
+            })
+    return variants
+
+async def load_image_source(url: str) -> bytes:
+    """Download an image URL, or read a file:// URL from IMAGE_SOURCE_DIR"""
+    if url.startswith("file://"):
+        path = (IMAGE_SOURCE_DIR / url[len("file://"):].lstrip("/")).resolve()
+        if not path.is_relative_to(IMAGE_SOURCE_DIR.resolve()) or not path.is_file():
+            raise HTTPException(status_code=400, detail=f"Image source not found: {url}")
+        return path.read_bytes()
+    try:
+        async with httpx.AsyncClient(timeout=20) as http:
+            # Redirecciones a mano para validar también cada destino
+            for _ in range(IMAGE_MAX_REDIRECTS + 1):
+                target = httpx.URL(url)
+                if target.scheme != "https" or target.host.lower() not in IMAGE_ALLOWED_HOSTS:
+                    raise HTTPException(status_code=400, detail=f"Image host not allowed: {target.host or url}")
+                async with http.stream("GET", target) as response:
+                    if response.is_redirect:
+                        url = str(target.join(response.headers["Location"]))
+                        continue
+                    response.raise_for_status()
+                    if int(response.headers.get("Content-Length") or 0) > IMAGE_MAX_BYTES:
+                        raise HTTPException(status_code=413, detail="Image too large")
+                    chunks, size = [], 0
+                    async for chunk in response.aiter_bytes():
+                        size += len(chunk)
+                        if size > IMAGE_MAX_BYTES:
+                            raise HTTPException(status_code=413, detail="Image too large")
+                        chunks.append(chunk)
+                    return b"".join(chunks)
+    except httpx.HTTPError as e:
+        raise HTTPException(status_code=502, detail=f"Could not fetch image: {e}")
+    raise HTTPException(status_code=502, detail="Could not fetch image: too many redirects")
+
+async def process_product_image(product_id: str, source: bytes) -> List[Dict]:
+    """Generate the variants of a product image and attach them to the product"""
+    global image_pool
+    if len(source) > IMAGE_MAX_BYTES:
+        raise HTTPException(status_code=413, detail="Image too large")
+    digest = hashlib.sha256(source).hexdigest()
+    if image_pool is None:
+        image_pool = ProcessPoolExecutor(max_workers=IMAGE_WORKERS)
+    loop = asyncio.get_running_loop()
+    try:
+        variants = await loop.run_in_executor(
+            image_pool, render_image_variants, source, digest, IMAGE_WIDTHS, str(IMAGE_DIR))
+    except (OSError, Image.DecompressionBombError) as e:  # PIL.UnidentifiedImageError es un OSError
+        raise HTTPException(status_code=400, detail=f"Invalid image: {e}")
+    product = await db.products.find_one_and_update(
+        {"id": product_id},
+        {"$set": {"image_variants": variants}},
+        projection={"_id": 0, "id": 1}
+    )
+    if not product:
+        raise HTTPException(status_code=404, detail="Product not found")
+    invalidate_product_caches()
+    return variants
+
+@api_router.post("/products/{product_id}/image")
+async def upload_product_image(product_id: str, file: UploadFile = File(...)):
+    """Upload a product image and generate its responsive variants (admin only)"""
+    source = await file.read(IMAGE_MAX_BYTES + 1)
+    return {"image_variants": await process_product_image(product_id, source)}
+
+@api_router.post("/products/{product_id}/image/fetch")
+async def fetch_product_image(product_id: str, url: Optional[str] = None):
+    """Fetch the product's image_url (or the given URL) once and generate its variants (admin only)"""
+    if url is None:
+        product = await db.products.find_one({"id": product_id}, {"_id": 0, "image_url": 1})
+        if not product:
+            raise HTTPException(status_code=404, detail="Product not found")
+        url = product["image_url"]
+    source = await load_image_source(url)
+    return {"image_variants": await process_product_image(product_id, source)}
+
+@api_router.get("/images/{digest}/{filename}")
+async def get_image(digest: str, filename: str):
+    """Serve a generated image variant; the path is content addressed, so it is cached forever"""
+    if not IMAGE_NAME.match(f"{digest}/{filename}"):
+        raise HTTPException(status_code=404, detail="Image not found")
+    path = IMAGE_DIR / digest / filename
+    if not path.is_file():
+        raise HTTPException(status_code=404, detail="Image not found")
+    media_type = IMAGE_FORMATS[filename.rsplit(".", 1)[1]][1]
+    return FileResponse(path, media_type=media_type, headers={"Cache-Control": IMAGE_CACHE_CONTROL})
+
+async def process_all_product_images(force: bool = False) -> int:
+    """Generate variants for every product that has none yet (or all of them with force)"""
+    query = {} if force else {"image_variants": {"$in": [None, []]}}
+    products = await db.products.find(query, {"_id": 0, "id": 1, "image_url": 1}).to_list(None)
+    for product in products:
+        try:
+            await process_product_image(product["id"], await load_image_source(product["image_url"]))
+        except HTTPException as e:
+            logger.warning(f"Image for product {product['id']} skipped: {e.detail}")
+    return len(products)
+
+# ==================== INGREDIENT CATALOG ====================
+
+def recompute_escandallos(products: List[Dict], prices: Dict[str, CatalogIngredient]) -> List[Dict]:
+    """Re-cost the escandallo lines priced in the catalog and each product's food_cost.
+
+    Lines whose ingredient is not in `prices` (or is measured in another unit)
+    keep their current total_cost.
+    """
+    product_index = []
+    line_totals = []
+    repriced = []  # (position in line_totals, quantity, unit_cost)
+    for p_idx, product in enumerate(products):
+        for line in product.get("ingredients", []):
+            price = prices.get(line["name"])
+            if price and price.unit == line["unit"]:
+                repriced.append((len(line_totals), line["quantity"], price.unit_cost))
+            product_index.append(p_idx)
+            line_totals.append(line["total_cost"])
+    
+    totals = np.asarray(line_totals, dtype=float)
+    if repriced:
+        positions, quantities, unit_costs = (np.asarray(col) for col in zip(*repriced))
+        totals[positions] = np.round(quantities.astype(float) * unit_costs.astype(float), 4)
+    food_costs = np.bincount(np.asarray(product_index, dtype=int), weights=totals, minlength=len(products))
+    
+    # Volcar los resultados de vuelta a los documentos
+    position = 0
+    updated = []
+    for p_idx, product in enumerate(products):
+        lines = []
+        for line in product.get("ingredients", []):
+            price = prices.get(line["name"])
+            if price and price.unit == line["unit"]:
+                line = {**line, "unit_cost": price.unit_cost, "total_cost": float(totals[position])}
+            lines.append(line)
+            position += 1
+        updated.append({"id": product["id"], "ingredients": lines, "food_cost": round(float(food_costs[p_idx]), 4)})
+    return updated
+
+# Attempts to re-cost products whose escandallo changed under a propagation
+PROPAGATION_ATTEMPTS = 5
+
+async def propagate_ingredient_costs(ingredients: List[CatalogIngredient]) -> int:
+    """Re-cost every product using these ingredients with a single bulk write"""
+    prices = {ingredient.name: ingredient for ingredient in ingredients}
+    query = {"ingredients.name": {"$in": list(prices)}}
+    modified = 0
+    for _ in range(PROPAGATION_ATTEMPTS):
+        products = await db.products.find(query, {"_id": 0, "id": 1, "ingredients": 1}).to_list(None)
+        if not products:
+            break
+        
+        updated = recompute_escandallos(products, prices)
+        # Compare-and-set sobre el escandallo leído: otra propagación concurrente
+        # (otro ingrediente del mismo producto) no se pisa, se reintenta
+        result = await db.products.bulk_write([
+            UpdateOne(
+                {"id": u["id"], "ingredients": p["ingredients"]},
+                {"$set": {"ingredients": u["ingredients"], "food_cost": u["food_cost"]}}
+            )
+            for p, u in zip(products, updated)
+        ], ordered=False)
+        modified += result.modified_count
+        if result.matched_count == len(products):
+            break
+        # Los productos ya escritos casan en el siguiente intento sin cambiar nada
+        query = {"id": {"$in": [p["id"] for p in products]}}
+    else:
+        logger.warning(f"Ingredient costs for {list(prices)} still conflicting after {PROPAGATION_ATTEMPTS} attempts")
+    if modified:
+        invalidate_product_caches()
+    return modified
+
+@api_router.get("/ingredients", response_model=List[CatalogIngredient])
+async def get_ingredients():
+    """Get the ingredient catalog (admin only)"""
+    return await db.ingredients.find({}, {"_id": 0}).sort("name", 1).to_list(None)
+
+@api_router.post("/ingredients", response_model=CatalogIngredient)
+async def create_ingredient(ingredient_data: IngredientCreate):
+    """Add an ingredient to the catalog (admin only)"""
+    ingredient = CatalogIngredient(**ingredient_data.model_dump())
+    try:
+        await db.ingredients.insert_one(ingredient.model_dump())
+    except DuplicateKeyError:
+        raise HTTPException(status_code=409, detail="Ingredient already exists")
+    return ingredient
+
+@api_router.put("/ingredients/{ingredient_id}/price")
+async def update_ingredient_price(ingredient_id: str, price_update: IngredientPriceUpdate):
+    """Change an ingredient's unit cost and re-cost every escandallo that uses it (admin only)"""
+    updated = await db.ingredients.find_one_and_update(
+        {"id": ingredient_id},
+        {"$set": {"unit_cost": price_update.unit_cost, "updated_at": datetime.now(timezone.utc)}},
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
+    )
+    if not updated:
+        raise HTTPException(status_code=404, detail="Ingredient not found")
+    
+    ingredient = CatalogIngredient(**updated)
+    products_updated = await propagate_ingredient_costs([ingredient])
+    return {"ingredient": ingredient, "products_updated": products_updated}
+
+# ==================== STOCK LEDGER ====================
+
+def product_quantities(items: List[Dict]) -> Dict[str, float]:
+    """Units per product_id; a cart may have several lines for the same product"""
+    quantities: Dict[str, float] = {}
+    for item in items:
+        quantities[item["product_id"]] = quantities.get(item["product_id"], 0) + item["quantity"]
+    return quantities
+
+def ingredient_consumption(items: List[Dict], recipes: Dict[str, List[Dict]]) -> Dict[str, float]:
+    """Total quantity of each ingredient needed for a list of order lines, given product_id -> escandallo"""
+    consumption: Dict[str, float] = {}
+    for product_id, quantity in product_quantities(items).items():
+        for line in recipes.get(product_id, []):
+            consumption[line["name"]] = consumption.get(line["name"], 0.0) + line["quantity"] * quantity
+    return consumption
+
+async def read_stock(ingredient_names: List[str]) -> Dict[str, float]:
+    return {
+        s["name"]: s["quantity"]
+        for s in await db.stock.find({"name": {"$in": ingredient_names}}, {"_id": 0, "name": 1, "quantity": 1}).to_list(None)
+    }
+
+async def apply_stock_availability(ingredient_names: List[str], stock: Dict[str, float]) -> bool:
+    """Enable or disable the products using these ingredients for the given stock; True if any changed"""
+    products = await db.products.find(
+        {"ingredients.name": {"$in": ingredient_names}, "$or": [{"is_available": True}, {"unavailable_reason": "stock"}]},
+        {"_id": 0, "id": 1, "is_available": 1, "ingredients": 1}
+    ).to_list(None)
+    
+    # Solo cuentan los ingredientes con stock registrado; el resto no limita
+    to_disable, to_enable = [], []
+    for product in products:
+        makeable = all(
+            stock[line["name"]] >= line["quantity"]
+            for line in product.get("ingredients", []) if line["name"] in stock
+        )
+        if product.get("is_available") and not makeable:
+            to_disable.append(product["id"])
+        elif not product.get("is_available") and makeable:
+            to_enable.append(product["id"])
+    
+    changed = 0
+    if to_disable:
+        result = await db.products.update_many(
+            {"id": {"$in": to_disable}, "is_available": True},
+            {"$set": {"is_available": False, "unavailable_reason": "stock"}}
+        )
+        changed += result.modified_count
+        logger.info(f"Out of stock, disabled products: {to_disable}")
+    if to_enable:
+        result = await db.products.update_many(
+            {"id": {"$in": to_enable}, "unavailable_reason": "stock"},
+            {"$set": {"is_available": True, "unavailable_reason": None}}
+        )
+        changed += result.modified_count
+    return changed > 0
+
+# Rounds of refresh when stock keeps moving under a refresh
+STOCK_REFRESH_ATTEMPTS = 3
+
+async def refresh_stock_availability(ingredient_names: List[str]):
+    """Switch products off when an ingredient runs short, and back on once restocked.
+
+    The decision is made on a stock read, so after writing the stock is read
+    again: a restock that landed in between may have seen the products still
+    on and left them, and this refresh then runs again on the new levels.
+    """
+    stock = await read_stock(ingredient_names)
+    for _ in range(STOCK_REFRESH_ATTEMPTS):
+        if not await apply_stock_availability(ingredient_names, stock):
+            return
+        invalidate_product_caches()
+        current = await read_stock(ingredient_names)
+        if current == stock:
+            return
+        stock = current
+    logger.warning(f"Stock of {ingredient_names} kept changing during the availability refresh")
+
+def stock_sign(old_status: Optional[str], new_status: str) -> int:
+    """-1 when an order starts consuming stock (paid), +1 when a paid order is cancelled"""
+    if old_status not in SOLD_STATUSES and new_status in SOLD_STATUSES:
+        return -1
+    if old_status in SOLD_STATUSES and new_status == "cancelled":
+        return 1
+    return 0
+
+async def apply_stock_movements(changes: List[Tuple[Dict, Optional[str], str]]):
+    """Deplete stock when orders are paid, and put it back if paid orders are cancelled"""
+    moving = [(order, stock_sign(old, new), new) for order, old, new in changes if stock_sign(old, new)]
+    if not moving:
+        return
+    
+    product_ids = {item["product_id"] for order, _, _ in moving for item in order.get("items", [])}
+    recipes = {
+        p["id"]: p.get("ingredients", [])
+        for p in await db.products.find(
+            {"id": {"$in": list(product_ids)}},
+            {"_id": 0, "id": 1, "ingredients": 1}
+        ).to_list(None)
+    }
+    
+    now = datetime.now(timezone.utc)
+    totals: Dict[str, float] = {}
+    movements = []
+    for order, sign, new_status in moving:
+        for name, quantity in ingredient_consumption(order.get("items", []), recipes).items():
+            totals[name] = totals.get(name, 0.0) + sign * quantity
+            movements.append({"order_id": order.get("id"), "ingredient": name, "delta": sign * quantity,
+                              "status": new_status, "created_at": now})
+    if not totals:
+        return
+    
+    # Sin upsert: los ingredientes sin stock registrado no se controlan
+    result = await db.stock.bulk_write([
+        UpdateOne({"name": name}, {"$inc": {"quantity": delta}, "$currentDate": {"updated_at": True}})
+        for name, delta in totals.items()
+    ], ordered=False)
+    if not result.matched_count:
+        return
+    
+    await db.stock_movements.insert_many(movements, ordered=False)
+    await refresh_stock_availability(list(totals))
+
+@api_router.get("/stock", response_model=List[StockLevel])
+async def get_stock():
+    """Current stock level of every tracked ingredient (admin only)"""
+    return await db.stock.find({}, {"_id": 0}).sort("name", 1).to_list(None)
+
+@api_router.put("/stock/{ingredient_name}", response_model=StockLevel)
+async def adjust_stock(ingredient_name: str, adjustment: StockAdjustment):
+    """Set or adjust an ingredient's stock; starts tracking it if needed (admin only)"""
+    if (adjustment.quantity is None) == (adjustment.delta is None):
+        raise HTTPException(status_code=400, detail="Provide either quantity or delta")
+    
+    update: Dict = {"$set": {"updated_at": datetime.now(timezone.utc)}}
+    if adjustment.quantity is not None:
+        update["$set"]["quantity"] = adjustment.quantity
+    else:
+        update["$inc"] = {"quantity": adjustment.delta}
+    
+    unit = adjustment.unit
+    if not unit:
+        ingredient = await db.ingredients.find_one({"name": ingredient_name}, {"_id": 0, "unit": 1})
+        unit = ingredient["unit"] if ingredient else "ud"
+    update["$setOnInsert"] = {"name": ingredient_name, "unit": unit}
+    
+    stock = await db.stock.find_one_and_update(
+        {"name": ingredient_name},
+        update,
+        projection={"_id": 0},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    await db.stock_movements.insert_one({
+        "order_id": None,
+        "ingredient": ingredient_name,
+        "delta": adjustment.delta,
+        "quantity": adjustment.quantity,
+        "status": "adjustment",
+        "created_at": stock["updated_at"]
+    })
+    await refresh_stock_availability([ingredient_name])
+    return stock
+
+# ==================== ORDER FEED ====================
+
+# auto: use a Mongo change stream when connected to a replica set, else the in-process bus
+ORDER_FEED_MODE = os.environ.get('ORDER_FEED_MODE', 'auto')
+ORDER_FEED_HISTORY = int(os.environ.get('ORDER_FEED_HISTORY', '1000'))
+ORDER_FEED_HEARTBEAT = 15.0
+
+class OrderEventBus:
+    """In-process order event fan-out with a replay buffer for reconnecting clients"""
+
+    def __init__(self, history: int):
+        # El prefijo distingue ids de otra ejecución del proceso, que no se pueden reanudar
+        self.boot_id = uuid.uuid4().hex[:8]
+        self._seq = 0
+        self._history = deque(maxlen=history)
+        self._subscribers: List[asyncio.Queue] = []
+
+    def publish(self, event: Dict):
+        self._seq += 1
+        entry = (f"{self.boot_id}-{self._seq}", event)
+        self._history.append((self._seq, entry))
+        for queue in list(self._subscribers):
+            try:
+                queue.put_nowait(entry)
+            except asyncio.QueueFull:
+                # Un cliente demasiado lento se desconecta y reanuda con Last-Event-ID
+                self._subscribers.remove(queue)
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(None)
+
+    def subscribe(self, last_event_id: Optional[str]) -> Tuple[asyncio.Queue, List[Tuple[str, Dict]]]:
+        """Register a subscriber and return the buffered events it missed"""
+        missed = []
+        last_seq = last_event_id.rsplit("-", 1)[1] if last_event_id and last_event_id.startswith(f"{self.boot_id}-") else ""
+        if last_seq.isdigit():
+            missed = [entry for seq, entry in self._history if seq > int(last_seq)]
+        queue = asyncio.Queue(maxsize=ORDER_FEED_HISTORY)
+        self._subscribers.append(queue)
+        return queue, missed
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        if queue in self._subscribers:
+            self._subscribers.remove(queue)
+
+order_events = OrderEventBus(ORDER_FEED_HISTORY)
+order_feed_uses_change_stream = False
+
+def order_event(order: Dict, old_status: Optional[str], new_status: str) -> Dict:
+    return {
+        "type": "order.created" if old_status is None else "order.status",
+        "order_id": order.get("id"),
+        "status": new_status,
+        "previous_status": old_status,
+        "order": {**order, "status": new_status}
+    }
+
+async def detect_change_streams() -> bool:
+    """Change streams need a replica set or a sharded cluster"""
+    if ORDER_FEED_MODE != "auto":
+        return ORDER_FEED_MODE == "changestream"
+    try:
+        hello = await client.admin.command("hello")
+    except Exception as e:
+        logger.warning(f"Could not detect replica set, using in-process order feed: {e}")
+        return False
+    return "setName" in hello or hello.get("msg") == "isdbgrid"
+
+def _sse(event_id: Optional[str], event: Dict) -> str:
+    data = json.dumps(event, ensure_ascii=False, default=json_default)
+    prefix = f"id: {event_id}\n" if event_id else ""
+    return f"{prefix}event: {event['type']}\ndata: {data}\n\n"
+
+async def bus_feed(request: Request, last_event_id: Optional[str]):
+    queue, missed = order_events.subscribe(last_event_id)
+    try:
+        for event_id, event in missed:
+            yield _sse(event_id, event)
+        while not await request.is_disconnected():
+            try:
+                entry = await asyncio.wait_for(queue.get(), ORDER_FEED_HEARTBEAT)
+            except asyncio.TimeoutError:
+                yield ": heartbeat\n\n"
+                continue
+            if entry is None:
+                return
+            yield _sse(*entry)
+    finally:
+        order_events.unsubscribe(queue)
+
+# Change stream resume tokens carry their position as a hex string in _data
+RESUME_TOKEN_RE = re.compile(r"^(?:[0-9A-Fa-f]{2}){8,}$")
+
+def change_stream_resume_token(last_event_id: Optional[str]) -> Optional[Dict]:
+    """Resume token for a Last-Event-ID; None for ids of the in-process bus or anything else"""
+    if last_event_id and RESUME_TOKEN_RE.match(last_event_id):
+        return {"_data": last_event_id}
+    return None
+
+async def change_stream_feed(request: Request, last_event_id: Optional[str]):
+    pipeline = [{"$match": {"operationType": {"$in": ["insert", "update", "replace"]}}}]
+    resume_after = change_stream_resume_token(last_event_id)
+    sent = False
+    while True:
+        try:
+            async with db.orders.watch(
+                pipeline,
+                full_document="updateLookup",
+                resume_after=resume_after,
+                max_await_time_ms=int(ORDER_FEED_HEARTBEAT * 1000)
+            ) as stream:
+                while stream.alive and not await request.is_disconnected():
+                    change = await stream.try_next()
+                    sent = True
+                    if change is None:
+                        yield ": heartbeat\n\n"
+                        continue
+                    
+                    order = change.get("fullDocument") or {}
+                    order.pop("_id", None)
+                    updated = change.get("updateDescription", {}).get("updatedFields", {})
+                    if change["operationType"] == "update" and "status" not in updated:
+                        continue
+                    
+                    # El change stream no conoce el estado anterior
+                    event = order_event(order, None, order.get("status"))
+                    if change["operationType"] != "insert":
+                        event["type"] = "order.status"
+                    yield _sse(change["_id"]["_data"], event)
+            return
+        except OperationFailure as e:
+            # Un token que el servidor no reconoce o ya fuera del oplog: seguir sin reanudar
+            if sent or resume_after is None:
+                raise
+            logger.warning(f"Cannot resume order feed from {last_event_id}, starting from now: {e}")
+            resume_after = None
+
+@api_router.get("/admin/orders/stream")
+async def stream_orders(request: Request):
+    """Server-Sent Events feed of order creation and status changes, resumable via Last-Event-ID"""
+    last_event_id = request.headers.get("Last-Event-ID") or request.query_params.get("last_event_id")
+    feed = change_stream_feed if order_feed_uses_change_stream else bus_feed
+    return StreamingResponse(
+        feed(request, last_event_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+# ==================== ORDER LIFECYCLE ====================
+
+ORDER_STATUSES = ["pending", "paid", "preparing", "ready", "completed", "cancelled"]
+
+# Allowed status changes; completed and cancelled are final
+ORDER_TRANSITIONS = {
+    "pending": ("paid", "cancelled"),
+    "paid": ("preparing", "cancelled"),
+    "preparing": ("ready", "cancelled"),
+    "ready": ("completed", "cancelled"),
+    "completed": (),
+    "cancelled": (),
+}
+
+def statuses_leading_to(status: str) -> List[str]:
+    """Statuses an order may be in to move to `status`, for compare-and-set filters"""
+    return [s for s, targets in ORDER_TRANSITIONS.items() if status in targets]
+
+# Orders that have been paid for, whatever their kitchen status; they count towards revenue
+SOLD_STATUSES = ["paid", "preparing", "ready", "completed"]
+
+# Business days and pickup times are in the restaurant's local time
+BUSINESS_TIMEZONE = os.environ.get('BUSINESS_TIMEZONE', 'Europe/Madrid')
+
+# Keep a materialized stats document updated with $inc on every order write,
+# so the dashboard reads it in O(1) instead of aggregating the whole history
+STATS_MATERIALIZED = os.environ.get('STATS_MATERIALIZED', 'true').lower() == 'true'
+
+def status_change_inc(old_status: Optional[str], new_status: str, total: float) -> Dict:
+    """$inc document moving one order between status counters"""
+    inc = {f"by_status.{new_status}": 1, "seq": 1}
+    if old_status is None:
+        inc["total_orders"] = 1
+    else:
+        inc[f"by_status.{old_status}"] = -1
+    revenue_delta = (new_status in SOLD_STATUSES) - (old_status in SOLD_STATUSES)
+    if revenue_delta:
+        inc["revenue"] = revenue_delta * total
+    return inc
+
+async def compute_order_stats() -> Dict:
+    """Order counters and revenue computed by a single $group pipeline"""
+    groups = await db.orders.aggregate([
+        {"$group": {"_id": "$status", "count": {"$sum": 1}, "revenue": {"$sum": "$total"}}}
+    ]).to_list(None)
+    by_status = {g["_id"]: g["count"] for g in groups if g["_id"]}
+    return {
+        "total_orders": sum(g["count"] for g in groups),
+        "by_status": by_status,
+        "revenue": sum(g["revenue"] for g in groups if g["_id"] in SOLD_STATUSES)
+    }
+
+async def rebuild_order_stats() -> Dict:
+    """Recompute the materialized stats document without losing concurrent $inc writes"""
+    for _ in range(3):
+        # Sembrar el documento antes de agregar: los $inc (sin upsert) que lleguen
+        # durante la agregación caen en él y suben seq, y el $set final no casa
+        marker = await db.stats.find_one_and_update(
+            {"_id": "orders"},
+            {"$setOnInsert": {"stale": True}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        stats = await compute_order_stats()
+        result = await db.stats.update_one(
+            {"_id": "orders", "seq": marker.get("seq")},
+            {"$set": {**stats, "stale": False}}
+        )
+        if result.matched_count:
+            return stats
+    # Sigue marcado como obsoleto: la próxima lectura lo vuelve a intentar
+    return stats
+
+def status_set(status: str) -> Dict:
+    """$set document moving an order to a status and stamping when it happened"""
+    now = datetime.now(timezone.utc)
+    return {"status": status, "status_updated_at": now, f"status_timestamps.{status}": now}
+
+async def on_order_status_changes(changes: List[Tuple[Dict, Optional[str], str]]):
+    """Propagate order creations (old_status=None) or status changes to derived data, one write per collection"""
+    changes = [(order, old, new) for order, old, new in changes if old != new]
+    if not changes:
+        return
+    for order, old_status, new_status in changes:
+        order_events.publish(order_event(order, old_status, new_status))
+    if STATS_MATERIALIZED:
+        inc: Dict[str, float] = {}
+        for order, old_status, new_status in changes:
+            for key, value in status_change_inc(old_status, new_status, order.get("total", 0)).items():
+                inc[key] = inc.get(key, 0) + value
+        # Sin upsert: si el documento no existe se reconstruye en la próxima lectura
+        await db.stats.update_one({"_id": "orders"}, {"$inc": inc})
+    sales_ops = [op for order, old_status, new_status in changes for op in daily_sales_ops(order, old_status, new_status)]
+    if sales_ops:
+        await db.daily_sales.bulk_write(sales_ops, ordered=False)
+    await apply_stock_movements(changes)
+    released: Dict[str, int] = {}
+    for order, _, new_status in changes:
+        if new_status == "cancelled" and order.get("pickup_slot"):
+            released[order["pickup_slot"]] = released.get(order["pickup_slot"], 0) + 1
+    if released:
+        await release_pickup_slots(released)
+
+async def on_order_status_change(order: Dict, old_status: Optional[str], new_status: str):
+    """Propagate an order creation (old_status=None) or status change to derived data"""
+    await on_order_status_changes([(order, old_status, new_status)])
+
+async def mark_session_paid(session_id: str):
+    """Mark the order paid through a checkout session as paid"""
+    order = await db.orders.find_one_and_update(
+        {"payment_session_id": session_id, "status": {"$in": statuses_leading_to("paid")}},
+        {"$set": status_set("paid")},
+        projection={"_id": 0},
+        return_document=ReturnDocument.BEFORE
+    )
+    if order:
+        await on_order_status_change(order, order.get("status"), "paid")
+    else:
+        await flag_paid_cancelled_orders([session_id])
+
+async def flag_paid_cancelled_orders(session_ids: List[str]):
+    """Flag orders cancelled before their checkout was paid so staff can refund them"""
+    cancelled = await db.orders.find(
+        {"payment_session_id": {"$in": session_ids}, "status": "cancelled", "paid_after_cancel": {"$ne": True}},
+        {"_id": 0, "id": 1, "payment_session_id": 1, "cancel_reason": 1}
+    ).to_list(None)
+    if not cancelled:
+        return
+    await db.orders.update_many(
+        {"id": {"$in": [o["id"] for o in cancelled]}},
+        {"$set": {"paid_after_cancel": True}}
+    )
+    for order in cancelled:
+        logger.error(
+            f"Checkout {order['payment_session_id']} was paid but order {order['id']} is cancelled "
+            f"({order.get('cancel_reason', 'manual')}); it needs a refund"
+        )
+
+def as_utc(value) -> datetime:
+    """Treat naive datetimes from query strings as UTC; ISO strings (pre-migration documents) are parsed"""
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
+
+def created_at_filter(since: Optional[datetime], until: Optional[datetime]) -> Dict:
+    """created_at range condition for [since, until)"""
+    created_at_range = {}
+    if since:
+        created_at_range["$gte"] = as_utc(since)
+    if until:
+        created_at_range["$lt"] = as_utc(until)
+    return created_at_range
+
+def encode_cursor(order: Dict) -> str:
+    """Opaque keyset cursor pointing just after the given order"""
+    raw = json.dumps([as_utc(order["created_at"]).isoformat(), order["id"]])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> Tuple[datetime, str]:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        created_at, order_id = json.loads(base64.urlsafe_b64decode(padded))
+        return datetime.fromisoformat(created_at), order_id
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+async def mark_sessions_paid(session_ids: List[str]):
+    """Mark the orders of many checkout sessions as paid with one bulk write"""
+    orders = await db.orders.find(
+        {"payment_session_id": {"$in": session_ids}, "status": {"$in": statuses_leading_to("paid")}},
+        {"_id": 0}
+    ).to_list(None)
+    unmatched = set(session_ids) - {o["payment_session_id"] for o in orders}
+    if unmatched:
+        await flag_paid_cancelled_orders(list(unmatched))
+    if not orders:
+        return
+
+    # Compare-and-set sobre el estado leído; la marca identifica qué órdenes cambió este lote
+    batch_id = str(uuid.uuid4())
+    result = await db.orders.bulk_write([
+        UpdateOne(
+            {"id": o["id"], "status": o.get("status")},
+            {"$set": {**status_set("paid"), "paid_batch_id": batch_id}}
+        )
+        for o in orders
+    ], ordered=False)
+
+    if result.modified_count < len(orders):
+        changed = await db.orders.distinct(
+            "id", {"id": {"$in": [o["id"] for o in orders]}, "paid_batch_id": batch_id})
+        orders = [o for o in orders if o["id"] in set(changed)]
+    await on_order_status_changes([(o, o.get("status"), "paid") for o in orders])
+
+# ==================== PICKUP SLOTS ====================
+
+SLOT_MINUTES = 15
+SLOT_CAPACITY = int(os.environ.get('SLOT_CAPACITY', '10'))
+# Service hours shown in the availability grid, e.g. "12:00-16:00,19:30-23:00"
+SLOT_SERVICE_HOURS = os.environ.get('SLOT_SERVICE_HOURS', '12:00-23:00')
+
+def _minutes(hhmm: str) -> int:
+    hours, minutes = hhmm.split(":")
+    return int(hours) * 60 + int(minutes)
+
+def service_slot_times() -> List[str]:
+    times = []
+    for window in SLOT_SERVICE_HOURS.split(","):
+        start, end = window.strip().split("-")
+        for minute in range(_minutes(start), _minutes(end), SLOT_MINUTES):
+            times.append(f"{minute // 60:02d}:{minute % 60:02d}")
+    return times
+
+def pickup_slot_key(pickup_time: str, now: Optional[datetime] = None) -> str:
+    """Slot key for a pickup time given as HH:MM (next occurrence) or YYYY-MM-DDTHH:MM"""
+    local_now = (now or datetime.now(timezone.utc)).astimezone(ZoneInfo(BUSINESS_TIMEZONE))
+    try:
+        if "T" in pickup_time:
+            when = datetime.fromisoformat(pickup_time)
+            day, minute = when.date(), when.hour * 60 + when.minute
+        else:
+            day, minute = local_now.date(), _minutes(pickup_time)
+            # Una hora "anterior" a la actual (p.ej. 00:15 pedido a las 23:50) es de mañana
+            if minute < local_now.hour * 60 + local_now.minute - 60:
+                day += timedelta(days=1)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid pickup_time, expected HH:MM")
+    if not 0 <= minute < 24 * 60:
+        raise HTTPException(status_code=400, detail="Invalid pickup_time, expected HH:MM")
+    
+    minute -= minute % SLOT_MINUTES
+    return f"{day.isoformat()}T{minute // 60:02d}:{minute % 60:02d}"
+
+async def _take_slot(slot_key: str) -> bool:
+    day, slot_time = slot_key.split("T")
+    for attempt in range(2):
+        # $expr no se admite en el filtro de un upsert: el $inc condicional va sin upsert
+        result = await db.pickup_slots.update_one(
+            {"_id": slot_key, "$expr": {"$lt": ["$reserved", "$capacity"]}},
+            {"$inc": {"reserved": 1}}
+        )
+        if result.matched_count:
+            return True
+        if attempt:
+            break
+        # El slot puede no existir todavía: crearlo vacío y reintentar una vez
+        try:
+            created = await db.pickup_slots.update_one(
+                {"_id": slot_key},
+                {"$setOnInsert": {"day": day, "time": slot_time, "capacity": SLOT_CAPACITY, "reserved": 0}},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            # Dos peticiones creando el mismo slot a la vez: ya existe
+            continue
+        if created.upserted_id is None:
+            # Ya existía, así que estaba lleno
+            break
+    return False
+
+async def reserve_pickup_slot(slot_key: str):
+    """Take one unit of a slot's capacity with a conditional $inc; 409 when it is full"""
+    if await _take_slot(slot_key):
+        return
+    # Los huecos de pedidos abandonados los libera el barrido en segundo plano
+    raise HTTPException(status_code=409, detail=f"Pickup slot {slot_key.split('T')[1]} is full")
+
+async def release_pickup_slot(slot_key: str):
+    await db.pickup_slots.update_one({"_id": slot_key, "reserved": {"$gt": 0}}, {"$inc": {"reserved": -1}})
+
+async def release_pickup_slots(counts: Dict[str, int]):
+    """Give back several reservations per slot in one bulk write, never going below zero"""
+    await db.pickup_slots.bulk_write([
+        UpdateOne({"_id": slot_key}, [{"$set": {"reserved": {"$max": [0, {"$subtract": ["$reserved", count]}]}}}])
+        for slot_key, count in counts.items()
+    ], ordered=False)
+
+# Unpaid orders older than this are cancelled, giving their pickup slot back,
+# once Stripe reports their checkout session (if any) expired
+PENDING_ORDER_TTL_MINUTES = float(os.environ.get('PENDING_ORDER_TTL_MINUTES', '20'))
+PENDING_SWEEP_INTERVAL = float(os.environ.get('PENDING_SWEEP_INTERVAL', '60'))
+pending_sweep_task: Optional[asyncio.Task] = None
+
+async def checkout_session_state(session_id: str) -> str:
+    """Stripe status of an order's checkout session: open, complete or expired.
+
+    A paid session also marks its order paid through load_checkout_status.
+    """
+    if payments.checkout is None:
+        payments.start()
+    status = await load_checkout_status(payments.checkout, session_id)
+    return status["status"]
+
+async def expire_pending_orders() -> int:
+    """Cancel pending orders past PENDING_ORDER_TTL_MINUTES, releasing their pickup slots.
+
+    Orders with a checkout session are only cancelled once Stripe reports the
+    session expired; an open session can still be paid.
+    """
+    cutoff = datetime.now(timezone.utc) - timedelta(minutes=PENDING_ORDER_TTL_MINUTES)
+    stale = await db.orders.find(
+        {"status": "pending", "created_at": {"$lt": cutoff}},
+        {"_id": 0}
+    ).to_list(None)
+    expired = 0
+    for order in stale:
+        if order.get("payment_session_id"):
+            try:
+                if await checkout_session_state(order["payment_session_id"]) != "expired":
+                    continue
+            except Exception as e:
+                # Sin respuesta de Stripe no se cancela: podría estar pagado
+                logger.warning(f"Could not check checkout of pending order {order['id']}: {e}")
+                continue
+        # Compare-and-set: un pago o un checkout creado a la vez gana
+        moved = await db.orders.find_one_and_update(
+            {"id": order["id"], "status": "pending", "payment_session_id": order.get("payment_session_id")},
+            {"$set": {**status_set("cancelled"), "cancel_reason": "expired"}},
+            projection={"_id": 0},
+            return_document=ReturnDocument.BEFORE
+        )
+        if moved:
+            await on_order_status_change(moved, "pending", "cancelled")
+            expired += 1
+    if expired:
+        logger.info(f"Expired {expired} unpaid orders older than {PENDING_ORDER_TTL_MINUTES:g} minutes")
+    return expired
+
+async def sweep_pending_orders():
+    while True:
+        try:
+            await expire_pending_orders()
+        except Exception as e:
+            logger.error(f"Pending order sweep failed: {e}")
+        await asyncio.sleep(PENDING_SWEEP_INTERVAL)
+
+@api_router.get("/slots")
+async def get_pickup_slots(day: Optional[date] = None):
+    """Pickup slot availability for a day (default today)"""
+    day = day or datetime.now(ZoneInfo(BUSINESS_TIMEZONE)).date()
+    stored = await db.pickup_slots.find({"day": day.isoformat()}).to_list(None)
+    by_time = {slot["time"]: slot for slot in stored}
+    
+    slots = []
+    for slot_time in sorted(set(service_slot_times()) | set(by_time)):
+        slot = by_time.get(slot_time, {})
+        capacity = slot.get("capacity", SLOT_CAPACITY)
+        reserved = slot.get("reserved", 0)
+        slots.append({
+            "time": slot_time,
+            "capacity": capacity,
+            "reserved": reserved,
+            "available": max(capacity - reserved, 0)
+        })
+    return {"day": day, "slot_minutes": SLOT_MINUTES, "slots": slots}
+
+@api_router.put("/slots/{day}/{slot_time}")
+async def set_pickup_slot_capacity(day: date, slot_time: str, capacity: int = Query(..., ge=0)):
+    """Override the capacity of one pickup slot (admin only)"""
+    slot_key = pickup_slot_key(f"{day.isoformat()}T{slot_time}")
+    _, slot_time = slot_key.split("T")
+    await db.pickup_slots.update_one(
+        {"_id": slot_key},
+        {"$set": {"capacity": capacity}, "$setOnInsert": {"day": day.isoformat(), "time": slot_time, "reserved": 0}},
+        upsert=True
+    )
+    return {"slot": slot_key, "capacity": capacity}
+
+# ==================== ADMISSION CONTROL ====================
+
+# Reverse proxies in front of the app that append to X-Forwarded-For. The client
+# IP is the entry the outermost one added; 0 ignores the header (direct clients)
+TRUSTED_PROXY_HOPS = int(os.environ.get('TRUSTED_PROXY_HOPS', '0'))
+# Per-client limits need the real client IP. Without proxy hops every customer
+# behind the ingress shares its address, so they are off unless set to 1 (app
+# reached directly) or proxy hops are configured
+ADMISSION_PER_CLIENT = os.environ.get(
+    'ADMISSION_PER_CLIENT', '1' if TRUSTED_PROXY_HOPS else '0').lower() in ("1", "true", "yes")
+# Per-client buckets kept in memory before the least recently seen are dropped
+ADMISSION_MAX_CLIENTS = int(os.environ.get('ADMISSION_MAX_CLIENTS', '10000'))
+
+class TokenBucket:
+    """Refills `rate` tokens per second up to `burst`; rate 0 means unlimited"""
+
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self) -> float:
+        """Take a token; returns 0 on success or the seconds until one is available"""
+        if self.rate <= 0:
+            return 0.0
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+def admission_setting(gate: str, key: str, default: str) -> float:
+    return float(os.environ.get(f"{gate.upper()}_{key}", default))
+
+def client_ip(request: Request) -> str:
+    forwarded = request.headers.get("X-Forwarded-For") if TRUSTED_PROXY_HOPS else None
+    if forwarded:
+        # Las entradas de la izquierda las pone el cliente y no son fiables
+        hops = [entry.strip() for entry in forwarded.split(",")]
+        return hops[-min(TRUSTED_PROXY_HOPS, len(hops))]
+    return request.client.host if request.client else "unknown"
+
+class AdmissionGate:
+    """Per-route concurrency limit with a bounded wait queue, plus token buckets per route and per client IP
+
+    Used as a route dependency: the slot is held while the endpoint runs.
+    Rate limits answer 429 and a full or stalled queue answers 503, both
+    with Retry-After, so bursts are shed before reaching Mongo or Stripe.
+    Settings come from <GATE>_CONCURRENCY, _QUEUE, _QUEUE_TIMEOUT, _RATE,
+    _BURST, _IP_RATE, _IP_BURST and _IP_CONCURRENCY; the per-IP ones only
+    apply with ADMISSION_PER_CLIENT.
+    """
+
+    def __init__(self, name: str, concurrency: int, queue: int, queue_timeout: float,
+                 rate: float, burst: float, ip_rate: float, ip_burst: float, ip_concurrency: int):
+        self.name = name
+        self.slots = asyncio.Semaphore(concurrency)
+        self.queue = queue
+        self.queue_timeout = queue_timeout
+        self.waiting = 0
+        self.route_bucket = TokenBucket(rate, burst)
+        self.ip_rate = ip_rate
+        self.ip_burst = ip_burst
+        self.ip_concurrency = ip_concurrency
+        self.per_client = ADMISSION_PER_CLIENT
+        self.ip_buckets: "OrderedDict[str, TokenBucket]" = OrderedDict()
+        self.ip_active: Dict[str, int] = {}
+
+    @classmethod
+    def from_env(cls, name: str, concurrency: int, queue: int, rate: float, ip_rate: float) -> "AdmissionGate":
+        return cls(
+            name,
+            concurrency=int(admission_setting(name, "CONCURRENCY", str(concurrency))),
+            queue=int(admission_setting(name, "QUEUE", str(queue))),
+            queue_timeout=admission_setting(name, "QUEUE_TIMEOUT", "5"),
+            rate=admission_setting(name, "RATE", str(rate)),
+            burst=admission_setting(name, "BURST", str(rate * 2)),
+            ip_rate=admission_setting(name, "IP_RATE", str(ip_rate)),
+            ip_burst=admission_setting(name, "IP_BURST", "5"),
+            ip_concurrency=int(admission_setting(name, "IP_CONCURRENCY", "2")),
+        )
+
+    def reject(self, status_code: int, reason: str, retry_after: float):
+        ADMISSION_REJECTIONS.inc((self.name, reason))
+        detail = "Too many requests" if status_code == 429 else "Server busy, try again"
+        raise HTTPException(status_code=status_code, detail=detail,
+                            headers={"Retry-After": str(max(1, int(retry_after + 0.999)))})
+
+    def ip_bucket(self, ip: str) -> TokenBucket:
+        bucket = self.ip_buckets.get(ip)
+        if bucket is None:
+            bucket = self.ip_buckets[ip] = TokenBucket(self.ip_rate, self.ip_burst)
+            if len(self.ip_buckets) > ADMISSION_MAX_CLIENTS:
+                self.ip_buckets.popitem(last=False)
+        else:
+            self.ip_buckets.move_to_end(ip)
+        return bucket
+
+    async def __call__(self, request: Request):
+        # Sin límites por cliente todas las peticiones comparten una clave
+        ip = client_ip(request) if self.per_client else ""
+        if self.per_client:
+            wait = self.ip_bucket(ip).take()
+            if wait:
+                self.reject(429, "client_rate", wait)
+            if self.ip_active.get(ip, 0) >= self.ip_concurrency:
+                self.reject(429, "client_concurrency", 1)
+        wait = self.route_bucket.take()
+        if wait:
+            self.reject(429, "route_rate", wait)
+        if self.slots.locked() and self.waiting >= self.queue:
+            self.reject(503, "queue_full", self.queue_timeout)
+
+        self.ip_active[ip] = self.ip_active.get(ip, 0) + 1
+        try:
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(self.slots.acquire(), self.queue_timeout)
+            except asyncio.TimeoutError:
+                self.reject(503, "queue_timeout", self.queue_timeout)
+            finally:
+                self.waiting -= 1
+            try:
+                yield
+            finally:
+                self.slots.release()
+        finally:
+            self.ip_active[ip] -= 1
+            if not self.ip_active[ip]:
+                del self.ip_active[ip]
+
+order_admission = AdmissionGate.from_env("orders", concurrency=20, queue=100, rate=50, ip_rate=0.5)
+checkout_admission = AdmissionGate.from_env("checkout", concurrency=10, queue=50, rate=20, ip_rate=0.5)
+
 # ==================== ORDER ENDPOINTS ====================
 
-@api_router.post("/orders", response_model=Order)
+@api_router.post("/orders", response_model=Order, dependencies=[Depends(order_admission)])
 async def create_order(order_data: OrderCreate):
-    """Create a new order"""
-    total = sum(item.price * item.quantity for item in order_data.items)
+    """Create a new order, priced server side from the product catalog"""
+    items, pricing = await price_order_items(order_data.items)
     
     order = Order(
-        items=order_data.items,
+        items=items,
         customer_name=order_data.customer_name,
         customer_email=order_data.customer_email,
         customer_phone=order_data.customer_phone,
         pickup_time=order_data.pickup_time,
         notes=order_data.notes or "",
-        total=round(total, 2)
+        **pricing
     )
     
+    order.status_updated_at = order.created_at
+    order.status_timestamps = {order.status: order.created_at}
+    order.pickup_slot = pickup_slot_key(order_data.pickup_time)
+    await reserve_pickup_slot(order.pickup_slot)
+    
     doc = order.model_dump()
-    doc['created_at'] = doc['created_at'].isoformat()
-    await db.orders.insert_one(doc)
+    try:
+        await db.orders.insert_one(doc)
+    except Exception:
+        await release_pickup_slot(order.pickup_slot)
+        raise
+    await on_order_status_change(doc, None, order.status)
     
     return order
 
 @api_router.get("/orders", response_model=List[Order])
-async def get_orders(status: Optional[str] = None):
-    """Get all orders (admin only)"""
+async def get_orders(
+    response: Response,
+    status: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(100, ge=1, le=500)
+):
+    """Get orders newest first (admin only), paginated by the X-Next-Cursor header"""
+    # Con fechas string y nativas mezcladas el orden y el keyset no son fiables
+    await wait_for_migration("native_dates")
+    
     query = {}
     if status:
         query["status"] = status
     
-    orders = await db.orders.find(query, {"_id": 0}).sort("created_at", -1).to_list(100)
-    for o in orders:
-        if isinstance(o.get('created_at'), str):
-            o['created_at'] = datetime.fromisoformat(o['created_at'])
+    created_at_range = created_at_filter(since, until)
+    if created_at_range:
+        query["created_at"] = created_at_range
+    
+    # Keyset: (created_at, id) estrictamente menor que el último de la página anterior
+    if cursor:
+        cursor_created_at, cursor_id = decode_cursor(cursor)
+        query["$or"] = [
+            {"created_at": {"$lt": cursor_created_at}},
+            {"created_at": cursor_created_at, "id": {"$lt": cursor_id}}
+        ]
+    
+    orders = await db.orders.find(query, {"_id": 0}) \
+        .sort([("created_at", -1), ("id", -1)]) \
+        .limit(limit + 1) \
+        .to_list(limit + 1)
+    
+    headers = {}
+    if len(orders) > limit:
+        orders = orders[:limit]
+        headers["X-Next-Cursor"] = encode_cursor(orders[-1])
+    
+    if FAST_RESPONSES:
+        return ORJSONResponse(order_dump.many(orders), headers=headers)
+    response.headers.update(headers)
     return orders
 
 @api_router.get("/orders/{order_id}", response_model=Order)
@@ -407,39 +2342,375 @@ async def get_order(order_id: str):
     order = await db.orders.find_one({"id": order_id}, {"_id": 0})
     if not order:
         raise HTTPException(status_code=404, detail="Order not found")
-    if isinstance(order.get('created_at'), str):
-        order['created_at'] = datetime.fromisoformat(order['created_at'])
+    if FAST_RESPONSES:
+        return ORJSONResponse(order_dump.one(order))
     return order
 
 @api_router.put("/orders/{order_id}/status")
 async def update_order_status(order_id: str, status: str):
     """Update order status (admin only)"""
-    valid_statuses = ["pending", "paid", "preparing", "ready", "completed", "cancelled"]
-    if status not in valid_statuses:
-        raise HTTPException(status_code=400, detail=f"Invalid status. Must be one of: {valid_statuses}")
+    if status not in ORDER_STATUSES:
+        raise HTTPException(status_code=400, detail=f"Invalid status. Must be one of: {ORDER_STATUSES}")
     
-    result = await db.orders.update_one({"id": order_id}, {"$set": {"status": status}})
-    if result.matched_count == 0:
-        raise HTTPException(status_code=404, detail="Order not found")
+    # Compare-and-set: solo se aplica si el estado actual permite la transición
+    order = await db.orders.find_one_and_update(
+        {"id": order_id, "status": {"$in": statuses_leading_to(status)}},
+        {"$set": status_set(status)},
+        projection={"_id": 0},
+        return_document=ReturnDocument.BEFORE
+    )
+    if not order:
+        # Segunda lectura solo en el camino de error, para distinguir 404 de 409
+        current = await db.orders.find_one({"id": order_id}, {"_id": 0, "status": 1})
+        if not current:
+            raise HTTPException(status_code=404, detail="Order not found")
+        if current.get("status") != status:
+            raise HTTPException(
+                status_code=409,
+                detail=f"Cannot change order from {current.get('status')} to {status}"
+            )
+        return {"message": f"Order status updated to {status}"}
+    await on_order_status_change(order, order.get("status"), status)
     
     return {"message": f"Order status updated to {status}"}
 
+@api_router.post("/orders/bulk/status")
+async def bulk_update_order_status(bulk: BulkOrderStatusUpdate):
+    """Move many orders to new statuses with one bulk write, reporting the outcome per order (admin only)"""
+    outcomes: List[Optional[str]] = []  # per item; None for the orders looked up below
+    targets = {}
+    for change in bulk.updates:
+        if change.order_id in targets:
+            outcomes.append("duplicate")
+        elif change.status not in ORDER_STATUSES:
+            outcomes.append("invalid_status")
+        else:
+            targets[change.order_id] = change.status
+            outcomes.append(None)
+
+    orders = await db.orders.find({"id": {"$in": list(targets)}}, {"_id": 0}).to_list(None) if targets else []
+    results = {order_id: "not_found" for order_id in targets}
+    to_change = []
+    for o in orders:
+        if o.get("status") == targets[o["id"]]:
+            results[o["id"]] = "unchanged"
+        elif targets[o["id"]] not in ORDER_TRANSITIONS.get(o.get("status"), ()):
+            results[o["id"]] = "invalid_transition"
+        else:
+            to_change.append(o)
+
+    if to_change:
+        # Compare-and-set sobre el estado leído, como en mark_sessions_paid
+        batch_id = str(uuid.uuid4())
+        result = await db.orders.bulk_write([
+            UpdateOne(
+                {"id": o["id"], "status": o.get("status")},
+                {"$set": {**status_set(targets[o["id"]]), "status_batch_id": batch_id}}
+            )
+            for o in to_change
+        ], ordered=False)
+        changed = {o["id"] for o in to_change}
+        if result.modified_count < len(to_change):
+            changed = set(await db.orders.distinct(
+                "id", {"id": {"$in": list(changed)}, "status_batch_id": batch_id}))
+        for o in to_change:
+            # Si no cambió, otro cliente modificó el pedido entre la lectura y la escritura
+            results[o["id"]] = "updated" if o["id"] in changed else "conflict"
+        await on_order_status_changes([
+            (o, o.get("status"), targets[o["id"]]) for o in to_change if o["id"] in changed
+        ])
+
+    items = [
+        {"order_id": change.order_id, "result": outcome or results[change.order_id]}
+        for change, outcome in zip(bulk.updates, outcomes)
+    ]
+    return {"updated": sum(r == "updated" for r in results.values()), "results": items}
+
+# ==================== PAYMENT CLIENT ====================
+
+STRIPE_API_KEY = os.environ.get('STRIPE_API_KEY', 'sk_test_emergent')
+STRIPE_TIMEOUT = float(os.environ.get('STRIPE_TIMEOUT', '10'))
+STRIPE_MAX_RETRIES = int(os.environ.get('STRIPE_MAX_RETRIES', '2'))
+# Public URL of this backend; the webhook URL is derived from it once
+PUBLIC_BACKEND_URL = os.environ.get('PUBLIC_BACKEND_URL', '').rstrip('/')
+
+class PaymentClient:
+    """Application-scoped Stripe checkout client over one pooled HTTP session"""
+
+    def __init__(self, api_key: str, base_url: str, timeout: float, max_retries: int):
+        self.api_key = api_key
+        self.webhook_url = f"{base_url}/api/webhook/stripe" if base_url else ""
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.http_client = None
+        self.checkout: Optional[StripeCheckout] = None
+
+    def start(self):
+        import stripe
+
+        # StripeCheckout usa el cliente global de stripe: compartir un pool
+        # mantiene las conexiones TLS abiertas entre peticiones
+        self.http_client = stripe.HTTPXClient(timeout=self.timeout, allow_sync_methods=True)
+        stripe.default_http_client = self.http_client
+        stripe.max_network_retries = self.max_retries
+        self.checkout = StripeCheckout(api_key=self.api_key, webhook_url=self.webhook_url)
+
+    def for_request(self, request: Request) -> StripeCheckout:
+        """Checkout client, deriving the webhook URL from the first request if not configured"""
+        if self.checkout is None:
+            self.start()
+        if not self.webhook_url:
+            self.webhook_url = f"{str(request.base_url).rstrip('/')}/api/webhook/stripe"
+            logger.warning(f"PUBLIC_BACKEND_URL not set, using webhook URL {self.webhook_url}")
+            self.checkout = StripeCheckout(api_key=self.api_key, webhook_url=self.webhook_url)
+        return self.checkout
+
+    async def close(self):
+        if self.http_client is not None:
+            await self.http_client.close_async()
+            self.http_client = None
+        self.checkout = None
+
+payments = PaymentClient(STRIPE_API_KEY, PUBLIC_BACKEND_URL, STRIPE_TIMEOUT, STRIPE_MAX_RETRIES)
+
+# ==================== CHECKOUT STATUS CACHE ====================
+
+# Seconds a non-terminal status (open, unpaid) is reused before asking Stripe again
+CHECKOUT_STATUS_TTL = float(os.environ.get('CHECKOUT_STATUS_TTL', '3'))
+CHECKOUT_STATUS_MAX_ENTRIES = 10000
+
+def is_terminal_status(result: Dict) -> bool:
+    return result.get("payment_status") == "paid" or result.get("status") == "expired"
+
+class CheckoutStatusCache:
+    """Per-session checkout status with single-flight upstream lookups"""
+
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: Dict[str, Tuple[float, Dict]] = {}
+        self._inflight: Dict[str, asyncio.Task] = {}
+
+    def invalidate(self, session_id: str):
+        self._entries.pop(session_id, None)
+
+    async def get(self, session_id: str, loader) -> Dict:
+        entry = self._entries.get(session_id)
+        if entry and entry[0] > time.monotonic():
+            return entry[1]
+
+        # Todas las peticiones concurrentes esperan la misma consulta a Stripe
+        task = self._inflight.get(session_id)
+        if task is None:
+            task = asyncio.ensure_future(self._load(session_id, loader))
+            self._inflight[session_id] = task
+        return await asyncio.shield(task)
+
+    async def _load(self, session_id: str, loader) -> Dict:
+        try:
+            result = await loader(session_id)
+            expires_at = float("inf") if is_terminal_status(result) else time.monotonic() + self.ttl
+            if len(self._entries) >= self.max_entries:
+                self._entries.pop(next(iter(self._entries)))
+            self._entries[session_id] = (expires_at, result)
+            return result
+        finally:
+            self._inflight.pop(session_id, None)
+
+checkout_status_cache = CheckoutStatusCache(CHECKOUT_STATUS_TTL, CHECKOUT_STATUS_MAX_ENTRIES)
+
+async def load_checkout_status(stripe_checkout: StripeCheckout, session_id: str) -> Dict:
+    """Checkout status from payment_transactions when already paid, otherwise from Stripe"""
+    tx = await db.payment_transactions.find_one({"session_id": session_id}, {"_id": 0})
+    if tx and tx.get('status') == "paid":
+        return {
+            "status": "complete",
+            "payment_status": "paid",
+            "amount_total": int(round(tx['amount'] * 100)),
+            "currency": tx.get('currency', "eur")
+        }
+    
+    status: CheckoutStatusResponse = await stripe_call(
+        "get_checkout_status", stripe_checkout.get_checkout_status(session_id))
+    
+    # Update transaction and order if paid
+    if status.payment_status == "paid" and tx:
+        await db.payment_transactions.update_one(
+            {"session_id": session_id, "status": {"$ne": "paid"}},
+            {"$set": {"status": "paid"}}
+        )
+        await mark_session_paid(session_id)
+    
+    return {
+        "status": status.status,
+        "payment_status": status.payment_status,
+        "amount_total": status.amount_total,
+        "currency": status.currency
+    }
+
+# ==================== WEBHOOK INBOX ====================
+
+WEBHOOK_WORKERS = int(os.environ.get('WEBHOOK_WORKERS', '2'))
+WEBHOOK_BATCH_SIZE = int(os.environ.get('WEBHOOK_BATCH_SIZE', '100'))
+WEBHOOK_POLL_INTERVAL = float(os.environ.get('WEBHOOK_POLL_INTERVAL', '1'))
+WEBHOOK_MAX_ATTEMPTS = 5
+# A claimed event not finished after this many seconds is picked up again
+WEBHOOK_CLAIM_TIMEOUT = 300
+
+class WebhookInbox:
+    """Durable Stripe event inbox drained by a pool of background workers"""
+
+    def __init__(self, workers: int, batch_size: int, poll_interval: float):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.processed_total = 0
+        self.failed_batches = 0
+        self.last_lag_seconds = 0.0
+        self._wakeup = asyncio.Event()
+        self._tasks: List[asyncio.Task] = []
+
+    async def enqueue(self, event: Dict) -> bool:
+        """Persist an event; returns False when it was already received"""
+        try:
+            await db.webhook_inbox.insert_one({
+                **event,
+                "status": "pending",
+                "attempts": 0,
+                "received_at": datetime.now(timezone.utc)
+            })
+        except DuplicateKeyError:
+            return False
+        self._wakeup.set()
+        return True
+
+    def start(self):
+        self._tasks = [asyncio.ensure_future(self._run(i)) for i in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _claim(self, worker_id: str) -> List[Dict]:
+        now = datetime.now(timezone.utc)
+        stale = now - timedelta(seconds=WEBHOOK_CLAIM_TIMEOUT)
+        claimable = {"$or": [
+            {"status": "pending"},
+            {"status": "processing", "claimed_at": {"$lt": stale}}
+        ]}
+        candidates = await db.webhook_inbox.find(claimable, {"_id": 1}) \
+            .sort("received_at", 1).limit(self.batch_size).to_list(self.batch_size)
+        if not candidates:
+            return []
+
+        # Otros workers (u otros procesos) pueden reclamar los mismos: solo nos quedamos con los nuestros
+        ids = [c["_id"] for c in candidates]
+        await db.webhook_inbox.update_many(
+            {"_id": {"$in": ids}, **claimable},
+            {"$set": {"status": "processing", "claimed_by": worker_id, "claimed_at": now}}
+        )
+        return await db.webhook_inbox.find({"_id": {"$in": ids}, "claimed_by": worker_id, "status": "processing"}) \
+            .to_list(None)
+
+    async def _apply(self, events: List[Dict]):
+        paid_sessions = list({e["session_id"] for e in events if e.get("payment_status") == "paid" and e.get("session_id")})
+        if paid_sessions:
+            await db.payment_transactions.bulk_write([
+                UpdateOne({"session_id": sid, "status": {"$ne": "paid"}}, {"$set": {"status": "paid"}})
+                for sid in paid_sessions
+            ], ordered=False)
+            await mark_sessions_paid(paid_sessions)
+            for sid in paid_sessions:
+                checkout_status_cache.invalidate(sid)
+
+    async def process_batch(self, worker_id: str) -> int:
+        events = await self._claim(worker_id)
+        if not events:
+            return 0
+
+        ids = [e["_id"] for e in events]
+        try:
+            await self._apply(events)
+        except Exception as e:
+            logger.error(f"Webhook batch failed: {e}")
+            self.failed_batches += 1
+            await db.webhook_inbox.update_many(
+                {"_id": {"$in": ids}},
+                {"$set": {"status": "pending", "last_error": str(e)}, "$inc": {"attempts": 1}}
+            )
+            await db.webhook_inbox.update_many(
+                {"_id": {"$in": ids}, "attempts": {"$gte": WEBHOOK_MAX_ATTEMPTS}},
+                {"$set": {"status": "failed"}}
+            )
+            return 0
+
+        now = datetime.now(timezone.utc)
+        await db.webhook_inbox.update_many(
+            {"_id": {"$in": ids}},
+            {"$set": {"status": "done", "processed_at": now}}
+        )
+        oldest = min(e["received_at"] for e in events)
+        self.last_lag_seconds = (now - oldest).total_seconds()
+        self.processed_total += len(events)
+        return len(events)
+
+    async def _run(self, index: int):
+        worker_id = f"{os.getpid()}-{index}-{uuid.uuid4().hex[:8]}"
+        while True:
+            try:
+                if await self.process_batch(worker_id):
+                    continue
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Webhook worker error: {e}")
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def metrics(self) -> Dict:
+        counts = await db.webhook_inbox.aggregate([
+            {"$match": {"status": {"$in": ["pending", "processing", "failed"]}}},
+            {"$group": {"_id": "$status", "count": {"$sum": 1}, "oldest": {"$min": "$received_at"}}}
+        ]).to_list(None)
+        by_status = {c["_id"]: c for c in counts}
+        waiting = [c["oldest"] for c in counts if c["_id"] in ("pending", "processing")]
+        oldest_age = 0.0
+        if waiting:
+            oldest_age = (datetime.now(timezone.utc) - min(waiting)).total_seconds()
+        for status in ("pending", "processing", "failed"):
+            WEBHOOK_INBOX_EVENTS.set((status,), by_status.get(status, {}).get("count", 0))
+        WEBHOOK_INBOX_OLDEST_SECONDS.set(value=oldest_age)
+        WEBHOOK_INBOX_LAG_SECONDS.set(value=self.last_lag_seconds)
+        return {
+            "queue_depth": sum(by_status.get(s, {}).get("count", 0) for s in ("pending", "processing")),
+            "failed": by_status.get("failed", {}).get("count", 0),
+            "oldest_pending_seconds": round(oldest_age, 3),
+            "last_batch_lag_seconds": round(self.last_lag_seconds, 3),
+            "processed_total": self.processed_total,
+            "failed_batches": self.failed_batches,
+            "workers": len(self._tasks)
+        }
+
+webhook_inbox = WebhookInbox(WEBHOOK_WORKERS, WEBHOOK_BATCH_SIZE, WEBHOOK_POLL_INTERVAL)
+
 # ==================== PAYMENT ENDPOINTS ====================
 
-@api_router.post("/checkout/stripe")
+@api_router.post("/checkout/stripe", dependencies=[Depends(checkout_admission)])
 async def create_stripe_checkout(checkout_req: CheckoutRequest, request: Request):
     """Create Stripe checkout session"""
     # Get order
     order = await db.orders.find_one({"id": checkout_req.order_id}, {"_id": 0})
     if not order:
         raise HTTPException(status_code=404, detail="Order not found")
+    if order.get("status") != "pending":
+        raise HTTPException(status_code=409, detail=f"Order is already {order.get('status')}")
     
-    # Initialize Stripe
-    stripe_api_key = os.environ.get('STRIPE_API_KEY', 'sk_test_emergent')
-    host_url = str(request.base_url).rstrip('/')
-    webhook_url = f"{host_url}/api/webhook/stripe"
-    
-    stripe_checkout = StripeCheckout(api_key=stripe_api_key, webhook_url=webhook_url)
+    stripe_checkout = payments.for_request(request)
     
     # Build URLs from origin
     origin = checkout_req.origin_url.rstrip('/')
@@ -458,7 +2729,16 @@ async def create_stripe_checkout(checkout_req: CheckoutRequest, request: Request
         }
     )
     
-    session: CheckoutSessionResponse = await stripe_checkout.create_checkout_session(checkout_request)
+    session: CheckoutSessionResponse = await stripe_call(
+        "create_checkout_session", stripe_checkout.create_checkout_session(checkout_request))
+    
+    # Update order with session info, unless it stopped being payable meanwhile
+    result = await db.orders.update_one(
+        {"id": checkout_req.order_id, "status": "pending"},
+        {"$set": {"payment_session_id": session.session_id, "payment_method": "stripe"}}
+    )
+    if not result.matched_count:
+        raise HTTPException(status_code=409, detail="Order is no longer pending")
     
     # Save payment transaction
     transaction = PaymentTransaction(
@@ -472,77 +2752,57 @@ async def create_stripe_checkout(checkout_req: CheckoutRequest, request: Request
     )
     
     tx_doc = transaction.model_dump()
-    tx_doc['created_at'] = tx_doc['created_at'].isoformat()
     await db.payment_transactions.insert_one(tx_doc)
     
-    # Update order with session info
-    await db.orders.update_one(
-        {"id": checkout_req.order_id},
-        {"$set": {"payment_session_id": session.session_id, "payment_method": "stripe"}}
-    )
-    
     return {"url": session.url, "session_id": session.session_id}
 
 @api_router.get("/checkout/status/{session_id}")
-async def get_checkout_status(session_id: str):
+async def get_checkout_status(session_id: str, request: Request):
     """Get payment status for a checkout session"""
-    stripe_api_key = os.environ.get('STRIPE_API_KEY', 'sk_test_emergent')
-    stripe_checkout = StripeCheckout(api_key=stripe_api_key, webhook_url="")
+    stripe_checkout = payments.for_request(request)
     
     try:
-        status: CheckoutStatusResponse = await stripe_checkout.get_checkout_status(session_id)
-        
-        # Update transaction and order if paid
-        if status.payment_status == "paid":
-            # Check if already processed
-            tx = await db.payment_transactions.find_one({"session_id": session_id})
-            if tx and tx.get('status') != "paid":
-                await db.payment_transactions.update_one(
-                    {"session_id": session_id},
-                    {"$set": {"status": "paid"}}
-                )
-                await db.orders.update_one(
-                    {"payment_session_id": session_id},
-                    {"$set": {"status": "paid"}}
-                )
-        
-        return {
-            "status": status.status,
-            "payment_status": status.payment_status,
-            "amount_total": status.amount_total,
-            "currency": status.currency
-        }
+        return await checkout_status_cache.get(
+            session_id,
+            lambda sid: load_checkout_status(stripe_checkout, sid)
+        )
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error checking payment status: {e}")
         raise HTTPException(status_code=400, detail=str(e))
 
 @api_router.post("/webhook/stripe")
 async def stripe_webhook(request: Request):
-    """Handle Stripe webhooks"""
+    """Verify a Stripe webhook and queue it for the inbox workers"""
+    body = await request.body()
     try:
-        body = await request.body()
         signature = request.headers.get("Stripe-Signature")
         
-        stripe_api_key = os.environ.get('STRIPE_API_KEY', 'sk_test_emergent')
-        stripe_checkout = StripeCheckout(api_key=stripe_api_key, webhook_url="")
-        
-        webhook_response = await stripe_checkout.handle_webhook(body, signature)
-        
-        if webhook_response.payment_status == "paid":
-            session_id = webhook_response.session_id
-            await db.payment_transactions.update_one(
-                {"session_id": session_id},
-                {"$set": {"status": "paid"}}
-            )
-            await db.orders.update_one(
-                {"payment_session_id": session_id},
-                {"$set": {"status": "paid"}}
-            )
-        
-        return {"status": "processed"}
+        stripe_checkout = payments.for_request(request)
+        # La verificación de la firma es local: no ocupa un hueco de Stripe
+        webhook_response = await stripe_call(
+            "handle_webhook", stripe_checkout.handle_webhook(body, signature), limit=False)
     except Exception as e:
+        # Firma o cuerpo inválidos: reintentar no lo arreglaría
         logger.error(f"Webhook error: {e}")
         return {"status": "error", "message": str(e)}
+    
+    event_id = webhook_response.event_id or hashlib.sha256(body).hexdigest()
+    try:
+        queued = await webhook_inbox.enqueue({
+            "event_id": event_id,
+            "event_type": webhook_response.event_type,
+            "session_id": webhook_response.session_id,
+            "payment_status": webhook_response.payment_status,
+            "payload": body.decode("utf-8", errors="replace")
+        })
+    except Exception as e:
+        # Sin persistir el evento hay que pedir a Stripe que lo reenvíe
+        logger.error(f"Could not store webhook {event_id}: {e}")
+        raise HTTPException(status_code=503, detail="Webhook not stored, retry later")
+    
+    return {"status": "queued" if queued else "duplicate"}
 
 # ==================== ADMIN ENDPOINTS ====================
 
@@ -557,25 +2817,302 @@ async def admin_login(login_data: AdminLogin):
     raise HTTPException(status_code=401, detail="Invalid credentials")
 
 @api_router.get("/admin/stats")
-async def get_admin_stats():
-    """Get admin dashboard statistics"""
-    total_products = await db.products.count_documents({})
-    total_orders = await db.orders.count_documents({})
-    pending_orders = await db.orders.count_documents({"status": "pending"})
-    paid_orders = await db.orders.count_documents({"status": "paid"})
+async def get_admin_stats(refresh: bool = False):
+    """Get admin dashboard statistics (refresh=true recomputes the materialized counters)"""
+    stats = None
+    if STATS_MATERIALIZED and not refresh:
+        stats = await db.stats.find_one({"_id": "orders"})
+    if not stats or stats.get("stale"):
+        stats = await rebuild_order_stats() if STATS_MATERIALIZED else await compute_order_stats()
     
-    # Calculate total revenue from paid orders
-    paid_orders_list = await db.orders.find({"status": {"$in": ["paid", "completed"]}}, {"total": 1}).to_list(1000)
-    total_revenue = sum(o.get('total', 0) for o in paid_orders_list)
+    total_products = await db.products.estimated_document_count()
+    by_status = stats.get("by_status", {})
     
     return {
         "total_products": total_products,
-        "total_orders": total_orders,
-        "pending_orders": pending_orders,
-        "paid_orders": paid_orders,
-        "total_revenue": round(total_revenue, 2)
+        "total_orders": stats.get("total_orders", 0),
+        "pending_orders": by_status.get("pending", 0),
+        "paid_orders": by_status.get("paid", 0),
+        "total_revenue": round(stats.get("revenue", 0), 2)
+    }
+
+@api_router.get("/admin/webhooks/metrics")
+async def get_webhook_metrics():
+    """Webhook inbox queue depth and processing lag"""
+    return await webhook_inbox.metrics()
+
+@api_router.get("/admin/indexes")
+async def get_index_report():
+    """Report index usage and flag query shapes that fall back to COLLSCAN"""
+    return await index_report()
+
+# ==================== ANALYTICS ====================
+
+def analytics_pipeline(match: Dict) -> List[Dict]:
+    """Units, revenue, food cost and gross margin per product and per category"""
+    line_revenue = {"$multiply": ["$items.price", "$items.quantity"]}
+    return [
+        {"$match": match},
+        {"$unwind": "$items"},
+        {"$group": {
+            "_id": "$items.product_id",
+            "product_name": {"$last": "$items.product_name"},
+            "units": {"$sum": "$items.quantity"},
+            "revenue": {"$sum": line_revenue},
+            # Márgenes sobre la base imponible: los precios incluyen IVA
+            "net_revenue": {"$sum": {"$divide": [line_revenue, {"$add": [1, {"$ifNull": ["$items.tax_rate", 0.10]}]}]}}
+        }},
+        {"$lookup": {"from": "products", "localField": "_id", "foreignField": "id", "as": "product"}},
+        {"$unwind": {"path": "$product", "preserveNullAndEmptyArrays": True}},
+        {"$project": {
+            "_id": 0,
+            "product_id": "$_id",
+            "name": {"$ifNull": ["$product.name", "$product_name"]},
+            "category": {"$ifNull": ["$product.category", "unknown"]},
+            "units": 1,
+            "revenue": 1,
+            "net_revenue": 1,
+            "food_cost": {"$multiply": ["$units", {"$ifNull": ["$product.food_cost", 0]}]}
+        }},
+        {"$addFields": {"gross_margin": {"$subtract": ["$net_revenue", "$food_cost"]}}},
+        {"$facet": {
+            "products": [{"$sort": {"revenue": -1}}],
+            "categories": [
+                {"$group": {
+                    "_id": "$category",
+                    "units": {"$sum": "$units"},
+                    "revenue": {"$sum": "$revenue"},
+                    "net_revenue": {"$sum": "$net_revenue"},
+                    "food_cost": {"$sum": "$food_cost"},
+                    "gross_margin": {"$sum": "$gross_margin"}
+                }},
+                {"$project": {
+                    "_id": 0, "category": "$_id", "units": 1, "revenue": 1,
+                    "net_revenue": 1, "food_cost": 1, "gross_margin": 1
+                }},
+                {"$sort": {"revenue": -1}}
+            ]
+        }}
+    ]
+
+def _round_figures(row: Dict) -> Dict:
+    for key in ("revenue", "net_revenue", "food_cost", "gross_margin"):
+        row[key] = round(row.get(key, 0), 2)
+    row["margin_pct"] = round(100 * row["gross_margin"] / row["net_revenue"], 1) if row["net_revenue"] else None
+    return row
+
+@api_router.get("/admin/analytics")
+async def get_analytics(since: Optional[datetime] = None, until: Optional[datetime] = None):
+    """Sales and margin per product and category for paid orders in [since, until)"""
+    match = {"status": {"$in": SOLD_STATUSES}}
+    created_at_range = created_at_filter(since, until)
+    if created_at_range:
+        match["created_at"] = created_at_range
+    
+    result = await db.orders.aggregate(analytics_pipeline(match)).to_list(1)
+    facets = result[0] if result else {"products": [], "categories": []}
+    
+    return {
+        "since": since,
+        "until": until,
+        "products": [_round_figures(row) for row in facets["products"]],
+        "categories": [_round_figures(row) for row in facets["categories"]]
     }
 
+# ==================== DAILY SALES ROLLUPS ====================
+
+ROLLUP_REBUILD_DAYS = 7
+
+def order_day(created_at) -> str:
+    return as_utc(created_at).astimezone(ZoneInfo(BUSINESS_TIMEZONE)).date().isoformat()
+
+def daily_sales_ops(order: Dict, old_status: Optional[str], new_status: str) -> List[UpdateOne]:
+    """Rollup updates adding or removing an order's lines when it enters or leaves a sold status"""
+    sign = (new_status in SOLD_STATUSES) - (old_status in SOLD_STATUSES)
+    if not sign or not order.get("items"):
+        return []
+    
+    day = order_day(order["created_at"])
+    ops = []
+    for item in order["items"]:
+        revenue = item["price"] * item["quantity"]
+        ops.append(UpdateOne(
+            {"_id": f"{day}:{item['product_id']}"},
+            {
+                "$inc": {
+                    "units": sign * item["quantity"],
+                    "revenue": sign * revenue,
+                    "net_revenue": sign * revenue / (1 + (item.get("tax_rate") or 0.10)),
+                    "orders": sign
+                },
+                "$set": {"day": day, "product_id": item["product_id"], "product_name": item["product_name"]}
+            },
+            upsert=True
+        ))
+    return ops
+
+def daily_sales_pipeline(start: datetime, end: datetime) -> List[Dict]:
+    """Recompute the rollup documents for orders created in [start, end)"""
+    line_revenue = {"$multiply": ["$items.price", "$items.quantity"]}
+    day = {"$dateToString": {"format": "%Y-%m-%d", "date": "$created_at", "timezone": BUSINESS_TIMEZONE}}
+    return [
+        {"$match": {"status": {"$in": SOLD_STATUSES}, "created_at": {"$gte": start, "$lt": end}}},
+        {"$unwind": "$items"},
+        {"$group": {
+            "_id": {"day": day, "product_id": "$items.product_id"},
+            "product_name": {"$last": "$items.product_name"},
+            "units": {"$sum": "$items.quantity"},
+            "revenue": {"$sum": line_revenue},
+            "net_revenue": {"$sum": {"$divide": [line_revenue, {"$add": [1, {"$ifNull": ["$items.tax_rate", 0.10]}]}]}},
+            "orders": {"$sum": 1}
+        }},
+        {"$project": {
+            "_id": {"$concat": ["$_id.day", ":", "$_id.product_id"]},
+            "day": "$_id.day",
+            "product_id": "$_id.product_id",
+            "product_name": 1, "units": 1, "revenue": 1, "net_revenue": 1, "orders": 1
+        }},
+        {"$merge": {"into": "daily_sales", "on": "_id", "whenMatched": "replace", "whenNotMatched": "insert"}}
+    ]
+
+def local_midnight(day: date) -> datetime:
+    return datetime(day.year, day.month, day.day, tzinfo=ZoneInfo(BUSINESS_TIMEZONE)).astimezone(timezone.utc)
+
+async def rebuild_daily_sales(first_day: date, last_day: date) -> int:
+    """Recompute the rollups for [first_day, last_day] from the orders, a few days per batch"""
+    batches = 0
+    day = first_day
+    while day <= last_day:
+        batch_end = min(day + timedelta(days=ROLLUP_REBUILD_DAYS - 1), last_day)
+        await db.daily_sales.delete_many({"day": {"$gte": day.isoformat(), "$lte": batch_end.isoformat()}})
+        await db.orders.aggregate(
+            daily_sales_pipeline(local_midnight(day), local_midnight(batch_end + timedelta(days=1)))
+        ).to_list(None)
+        logger.info(f"Rebuilt daily sales {day.isoformat()} .. {batch_end.isoformat()}")
+        batches += 1
+        day = batch_end + timedelta(days=1)
+    return batches
+
+def sales_period(day: str, group: str) -> str:
+    if group == "month":
+        return day[:7]
+    if group == "week":
+        year, week, _ = date.fromisoformat(day).isocalendar()
+        return f"{year}-W{week:02d}"
+    return day
+
+@api_router.get("/admin/sales")
+async def get_sales_report(
+    since_day: date,
+    until_day: date,
+    group: str = Query("day", pattern="^(day|week|month)$")
+):
+    """Sales per period and product from the daily rollups, both days inclusive"""
+    rollups = await db.daily_sales.find(
+        {"day": {"$gte": since_day.isoformat(), "$lte": until_day.isoformat()}},
+        {"_id": 0}
+    ).to_list(None)
+    
+    periods: Dict[str, Dict] = {}
+    for r in rollups:
+        period = periods.setdefault(sales_period(r["day"], group), {"units": 0, "revenue": 0.0, "net_revenue": 0.0, "products": {}})
+        product = period["products"].setdefault(r["product_id"], {
+            "product_id": r["product_id"], "name": r.get("product_name"), "units": 0, "revenue": 0.0
+        })
+        product["units"] += r["units"]
+        product["revenue"] += r["revenue"]
+        period["units"] += r["units"]
+        period["revenue"] += r["revenue"]
+        period["net_revenue"] += r["net_revenue"]
+    
+    return [
+        {
+            "period": key,
+            "units": p["units"],
+            "revenue": round(p["revenue"], 2),
+            "net_revenue": round(p["net_revenue"], 2),
+            "products": sorted(
+                ({**prod, "revenue": round(prod["revenue"], 2)} for prod in p["products"].values()),
+                key=lambda prod: prod["revenue"],
+                reverse=True
+            )
+        }
+        for key, p in sorted(periods.items())
+    ]
+
+# ==================== EXPORT ====================
+
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', '1000'))
+
+# Column order for CSV exports; nested values are written as JSON
+EXPORT_FIELDS = {
+    "orders": [
+        "id", "created_at", "status", "customer_name", "customer_email", "customer_phone",
+        "pickup_time", "pickup_slot", "notes", "subtotal", "tax", "tax_breakdown", "total",
+        "payment_method", "payment_session_id", "items"
+    ],
+    "payment_transactions": [
+        "id", "created_at", "order_id", "session_id", "amount", "currency",
+        "payment_method", "status", "metadata"
+    ],
+}
+
+def _csv_line(values: List) -> str:
+    buffer = io.StringIO()
+    csv.writer(buffer).writerow(values)
+    return buffer.getvalue()
+
+def _csv_value(value):
+    if isinstance(value, (list, dict)):
+        return json.dumps(value, ensure_ascii=False, default=json_default)
+    return "" if value is None else value
+
+async def export_lines(
+    collection: str,
+    fmt: str = "ndjson",
+    status: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None
+):
+    """Yield an export of a collection line by line, reading the cursor in batches"""
+    query = {}
+    if status:
+        query["status"] = status
+    created_at_range = created_at_filter(since, until)
+    if created_at_range:
+        query["created_at"] = created_at_range
+
+    fields = EXPORT_FIELDS[collection]
+    if fmt == "csv":
+        yield _csv_line(fields)
+
+    cursor = db[collection].find(query, {"_id": 0}).sort("created_at", 1).batch_size(EXPORT_BATCH_SIZE)
+    async for doc in cursor:
+        if fmt == "csv":
+            yield _csv_line([_csv_value(doc.get(field)) for field in fields])
+        else:
+            yield json.dumps(doc, ensure_ascii=False, default=json_default) + "\n"
+
+@api_router.get("/admin/export/{collection}")
+async def export_collection(
+    collection: str,
+    format: str = Query("ndjson", pattern="^(ndjson|csv)$"),
+    status: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None
+):
+    """Stream the full orders or payment_transactions history as NDJSON or CSV"""
+    if collection not in EXPORT_FIELDS:
+        raise HTTPException(status_code=404, detail=f"Unknown collection. Must be one of: {list(EXPORT_FIELDS)}")
+    
+    media_type = "text/csv" if format == "csv" else "application/x-ndjson"
+    extension = "csv" if format == "csv" else "ndjson"
+    return StreamingResponse(
+        export_lines(collection, format, status, since, until),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{collection}.{extension}"'}
+    )
+
 # ==================== ROOT ENDPOINT ====================
 
 @api_router.get("/")
@@ -585,6 +3122,71 @@ async def root():
 # Include router
 app.include_router(api_router)
 
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """Prometheus metrics for this worker process"""
+    try:
+        # Refresca los gauges de la cola de webhooks
+        await webhook_inbox.metrics()
+    except Exception as e:
+        logger.warning(f"Could not read webhook inbox metrics: {e}")
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+def route_template(scope: Dict) -> str:
+    """Path template of the matching route, so /api/orders/{order_id} is one series"""
+    for route in app.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+    return "unmatched"
+
+class MetricsMiddleware:
+    """Request latency, in-flight gauge and Mongo round trips, measured until the last body chunk is sent
+
+    A plain ASGI middleware: an @app.middleware("http") function returns once
+    the headers are ready, so SSE feeds and exports were only timed up to
+    their first byte.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        labels = (scope["method"], route_template(scope))
+        debug_headers = MONGO_DEBUG_HEADERS or "x-debug-mongo" in Headers(scope=scope)
+        HTTP_IN_FLIGHT.inc(labels)
+        profile = RequestProfile(f"{labels[0]} {labels[1]}")
+        status = 500
+
+        async def send_with_metrics(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if debug_headers:
+                    # En respuestas en streaming solo cuentan los comandos previos a las cabeceras
+                    headers = MutableHeaders(scope=message)
+                    headers["X-Mongo-Round-Trips"] = str(len(profile.commands))
+                    headers["X-Mongo-Time-Ms"] = f"{profile.total_ms:.1f}"
+            await send(message)
+
+        token = current_profile.set(profile)
+        try:
+            await self.app(scope, receive, send_with_metrics)
+        finally:
+            current_profile.reset(token)
+            HTTP_IN_FLIGHT.dec(labels)
+            HTTP_REQUEST_DURATION.observe(labels, time.perf_counter() - start)
+            HTTP_REQUESTS.inc(labels + (str(status),))
+            MONGO_REQUEST_COMMANDS.observe(labels, len(profile.commands))
+            if len(profile.commands) >= CHATTY_REQUEST_COMMANDS:
+                logger.info(f"Chatty request [{profile.label}] {len(profile.commands)} round trips: {profile.summary()}")
+
+app.add_middleware(MetricsMiddleware)
+
 # CORS middleware
 app.add_middleware(
     CORSMiddleware,
@@ -592,8 +3194,66 @@ app.add_middleware(
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "X-Next-Cursor", "X-Mongo-Round-Trips", "X-Mongo-Time-Ms", "Retry-After"],
 )
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    for task in migration_tasks.values():
+        task.cancel()
+    if pending_sweep_task is not None:
+        pending_sweep_task.cancel()
+    await webhook_inbox.stop()
+    await payments.close()
+    if image_pool is not None:
+        image_pool.shutdown(wait=False, cancel_futures=True)
     client.close()
+
+# ==================== CLI ====================
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="En Tu Sano Juicio backend maintenance commands")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("indexes", help="Reconcile indexes and print the index usage report")
+    migrate = commands.add_parser("migrate", help="Reconcile indexes and apply pending migrations")
+    migrate.add_argument("--force", action="store_true", help="Re-run every migration")
+    export = commands.add_parser("export", help="Export orders or payment transactions to stdout")
+    export.add_argument("collection", choices=sorted(EXPORT_FIELDS))
+    export.add_argument("--format", choices=["ndjson", "csv"], default="ndjson")
+    export.add_argument("--status")
+    export.add_argument("--since", type=datetime.fromisoformat)
+    export.add_argument("--until", type=datetime.fromisoformat)
+    rebuild = commands.add_parser("rebuild-daily-sales", help="Recompute the daily sales rollups for a day range")
+    rebuild.add_argument("--since", type=date.fromisoformat, required=True, help="First day (YYYY-MM-DD)")
+    rebuild.add_argument("--until", type=date.fromisoformat, required=True, help="Last day, inclusive")
+    images = commands.add_parser("images", help="Generate responsive image variants for the products")
+    images.add_argument("--force", action="store_true", help="Regenerate products that already have variants")
+    args = parser.parse_args()
+
+    async def run():
+        if args.command == "indexes":
+            await ensure_indexes()
+            report = await index_report()
+            print(json.dumps(report, indent=2))
+            if any(q["collscan"] for q in report["queries"]):
+                return 1
+        elif args.command == "migrate":
+            await run_migrations(force=args.force, wait=True)
+        elif args.command == "export":
+            async for line in export_lines(args.collection, args.format, args.status, args.since, args.until):
+                sys.stdout.write(line)
+        elif args.command == "rebuild-daily-sales":
+            await rebuild_daily_sales(args.since, args.until)
+        elif args.command == "images":
+            await process_all_product_images(force=args.force)
+        return 0
+
+    try:
+        return asyncio.run(run())
+    finally:
+        client.close()
+
+if __name__ == "__main__":
+    raise SystemExit(main())
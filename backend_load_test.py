@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+"""Local load test and latency benchmark for the En Tu Sano Juicio API.
+
+Runs the FastAPI app in-process (ASGI transport) or under uvicorn against a
+local MongoDB (or mongomock-motor with --in-memory), with Stripe replaced by
+a stub. Virtual users drive a weighted mix of menu browsing, order creation,
+checkout, status polling and admin dashboard reads. The report (JSON) has
+p50/p95/p99 latency and requests per second per endpoint, so runs of two
+versions can be compared.
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import sys
+import time
+import uuid
+from datetime import datetime
+from pathlib import Path
+from types import SimpleNamespace
+
+import httpx
+
+sys.path.insert(0, str(Path(__file__).parent / "backend"))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "entusanojuicio_loadtest")
+# Que las franjas de recogida no limiten la prueba
+os.environ.setdefault("SLOT_CAPACITY", "1000000")
+# Todo el tráfico sale de una IP: sin límites de ritmo por cliente ni por ruta
+os.environ.setdefault("ADMISSION_PER_CLIENT", "0")
+for gate in ("ORDERS", "CHECKOUT"):
+    os.environ.setdefault(f"{gate}_RATE", "0")
+
+import server  # noqa: E402
+
+# Weighted mix of user journeys
+SCENARIOS = {
+    "browse": 60,
+    "order": 15,
+    "checkout": 10,
+    "poll": 10,
+    "webhook": 3,
+    "admin": 5,
+}
+
+
+class StubStripeCheckout:
+    """In-memory replacement for StripeCheckout with a configurable latency"""
+
+    def __init__(self, latency, paid_after):
+        self.latency = latency
+        self.paid_after = paid_after
+        self.sessions = {}
+
+    async def create_checkout_session(self, request):
+        await asyncio.sleep(self.latency)
+        session_id = f"cs_test_{uuid.uuid4().hex}"
+        self.sessions[session_id] = (time.monotonic(), request.amount)
+        return SimpleNamespace(session_id=session_id, url=f"https://checkout.stripe.test/{session_id}")
+
+    async def get_checkout_status(self, session_id):
+        await asyncio.sleep(self.latency)
+        created, amount = self.sessions.get(session_id, (time.monotonic(), 0))
+        paid = time.monotonic() - created >= self.paid_after
+        return SimpleNamespace(
+            status="complete" if paid else "open",
+            payment_status="paid" if paid else "unpaid",
+            amount_total=int(round(amount * 100)),
+            currency="eur"
+        )
+
+    async def handle_webhook(self, body, signature):
+        event = json.loads(body)
+        return SimpleNamespace(
+            event_id=event["id"],
+            event_type="checkout.session.completed",
+            session_id=event["session_id"],
+            payment_status="paid"
+        )
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    # Nearest-rank
+    rank = math.ceil(pct / 100 * len(sorted_values))
+    return sorted_values[max(rank, 1) - 1]
+
+
+class EnTuSanoJuicioLoadTester:
+    def __init__(self, client, concurrency, duration, seed):
+        self.client = client
+        self.concurrency = concurrency
+        self.duration = duration
+        self.random = random.Random(seed)
+        self.latencies = {}
+        self.errors = {}
+        self.products = []
+        self.orders = []
+        self.sessions = []
+
+    async def call(self, label, method, url, **kwargs):
+        """Issue a request and record its latency under an endpoint label"""
+        start = time.perf_counter()
+        try:
+            response = await self.client.request(method, url, **kwargs)
+            ok = response.status_code < 400
+        except httpx.HTTPError:
+            response, ok = None, False
+        self.latencies.setdefault(label, []).append(time.perf_counter() - start)
+        if not ok:
+            self.errors[label] = self.errors.get(label, 0) + 1
+        return response if ok else None
+
+    async def browse(self):
+        await self.call("GET /api/products", "GET", "/api/products")
+        category = self.random.choice(["bowls", "ensaladas", "wraps"])
+        await self.call("GET /api/products?category", "GET", "/api/products", params={"category": category})
+        if self.products:
+            product = self.random.choice(self.products)
+            await self.call("GET /api/products/{id}", "GET", f"/api/products/{product['id']}")
+
+    async def order(self):
+        if not self.products:
+            return
+        items = [
+            {
+                "product_id": p["id"],
+                "quantity": self.random.randint(1, 3),
+                "product_name": p["name"],
+                "price": p["price"]
+            }
+            for p in self.random.sample(self.products, k=min(len(self.products), self.random.randint(1, 3)))
+        ]
+        response = await self.call("POST /api/orders", "POST", "/api/orders", json={
+            "items": items,
+            "customer_name": "Carga",
+            "customer_email": "carga@example.com",
+            "customer_phone": "600000000",
+            "pickup_time": self.random.choice(["13:00", "13:15", "13:30", "13:45", "14:00"]),
+            "notes": ""
+        })
+        if response is not None:
+            self.orders.append(response.json()["id"])
+
+    async def checkout(self):
+        if not self.orders:
+            return await self.order()
+        order_id = self.orders.pop()
+        response = await self.call("POST /api/checkout/stripe", "POST", "/api/checkout/stripe", json={
+            "order_id": order_id,
+            "origin_url": "http://localhost:3000"
+        })
+        if response is not None:
+            self.sessions.append(response.json()["session_id"])
+
+    async def poll(self):
+        if not self.sessions:
+            return await self.checkout()
+        session_id = self.random.choice(self.sessions[-50:])
+        await self.call("GET /api/checkout/status/{id}", "GET", f"/api/checkout/status/{session_id}")
+
+    async def webhook(self):
+        if not self.sessions:
+            return await self.checkout()
+        event = {"id": f"evt_{uuid.uuid4().hex}", "session_id": self.random.choice(self.sessions[-50:])}
+        await self.call("POST /api/webhook/stripe", "POST", "/api/webhook/stripe", content=json.dumps(event))
+
+    async def admin(self):
+        await asyncio.gather(
+            self.call("GET /api/admin/stats", "GET", "/api/admin/stats"),
+            self.call("GET /api/products?available_only=false", "GET", "/api/products", params={"available_only": "false"}),
+            self.call("GET /api/orders", "GET", "/api/orders", params={"limit": 50})
+        )
+
+    async def virtual_user(self, deadline):
+        names = list(SCENARIOS)
+        weights = [SCENARIOS[name] for name in names]
+        while time.monotonic() < deadline:
+            scenario = self.random.choices(names, weights)[0]
+            await getattr(self, scenario)()
+
+    async def run(self):
+        response = await self.client.get("/api/products")
+        response.raise_for_status()
+        self.products = response.json()
+
+        start = time.monotonic()
+        deadline = start + self.duration
+        await asyncio.gather(*(self.virtual_user(deadline) for _ in range(self.concurrency)))
+        return time.monotonic() - start
+
+    def report(self, elapsed):
+        endpoints = {}
+        for label, values in sorted(self.latencies.items()):
+            values = sorted(values)
+            endpoints[label] = {
+                "requests": len(values),
+                "errors": self.errors.get(label, 0),
+                "rps": round(len(values) / elapsed, 1),
+                "p50_ms": round(percentile(values, 50) * 1000, 2),
+                "p95_ms": round(percentile(values, 95) * 1000, 2),
+                "p99_ms": round(percentile(values, 99) * 1000, 2),
+                "max_ms": round(values[-1] * 1000, 2)
+            }
+        total = sum(e["requests"] for e in endpoints.values())
+        return {
+            "timestamp": datetime.now().isoformat(),
+            "concurrency": self.concurrency,
+            "duration_s": round(elapsed, 2),
+            "total_requests": total,
+            "total_errors": sum(self.errors.values()),
+            "rps": round(total / elapsed, 1),
+            "endpoints": endpoints
+        }
+
+
+def use_in_memory_database():
+    try:
+        from mongomock_motor import AsyncMongoMockClient
+    except ImportError:
+        sys.exit("--in-memory needs mongomock-motor (pip install mongomock-motor)")
+    server.client = AsyncMongoMockClient(tz_aware=True)
+    server.db = server.client[os.environ["DB_NAME"]]
+
+
+def install_stripe_stub(latency, paid_after):
+    stub = StubStripeCheckout(latency, paid_after)
+
+    def start():
+        server.payments.webhook_url = "http://loadtest/api/webhook/stripe"
+        server.payments.checkout = stub
+
+    server.payments.start = start
+    return stub
+
+
+async def run_asgi(args):
+    await server.startup_event()
+    try:
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://loadtest") as client:
+            tester = EnTuSanoJuicioLoadTester(client, args.concurrency, args.duration, args.seed)
+            return tester.report(await tester.run())
+    finally:
+        await server.shutdown_db_client()
+
+
+async def run_uvicorn(args):
+    import uvicorn
+
+    config = uvicorn.Config(server.app, host="127.0.0.1", port=args.port, log_level="warning")
+    uvicorn_server = uvicorn.Server(config)
+    serve = asyncio.ensure_future(uvicorn_server.serve())
+    while not uvicorn_server.started:
+        if serve.done():
+            raise RuntimeError("uvicorn failed to start")
+        await asyncio.sleep(0.05)
+    try:
+        limits = httpx.Limits(max_connections=args.concurrency * 3)
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{args.port}", limits=limits) as client:
+            tester = EnTuSanoJuicioLoadTester(client, args.concurrency, args.duration, args.seed)
+            return tester.report(await tester.run())
+    finally:
+        uvicorn_server.should_exit = True
+        await serve
+
+
+async def reset_database():
+    await server.client.drop_database(os.environ["DB_NAME"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--concurrency", type=int, default=20, help="Virtual users")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds to run")
+    parser.add_argument("--transport", choices=["asgi", "uvicorn"], default="asgi")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--in-memory", action="store_true", help="Use mongomock-motor instead of MongoDB")
+    parser.add_argument("--keep-data", action="store_true", help="Do not drop the test database first")
+    parser.add_argument("--stripe-latency", type=float, default=0.15, help="Seconds per stubbed Stripe call")
+    parser.add_argument("--paid-after", type=float, default=2.0, help="Seconds until a stub session is paid")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="Write the JSON report to this file")
+    args = parser.parse_args()
+
+    if args.in_memory:
+        use_in_memory_database()
+    install_stripe_stub(args.stripe_latency, args.paid_after)
+
+    async def run():
+        if not args.keep_data:
+            await reset_database()
+        if args.transport == "uvicorn":
+            return await run_uvicorn(args)
+        return await run_asgi(args)
+
+    report = asyncio.run(run())
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    return 0 if report["total_errors"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""CPU cost per request of the product and order list responses.
+
+Compares the default path (FastAPI re-validates the documents through the
+response_model and encodes them with the stdlib json) with the FAST_RESPONSES
+path (TrustedDump projection encoded with orjson). No database is needed.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+import uuid
+from datetime import datetime, timezone, timedelta
+from pathlib import Path
+from typing import List
+
+import orjson
+from pydantic import TypeAdapter
+
+sys.path.insert(0, str(Path(__file__).parent / "backend"))
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "benchmark")
+
+import server  # noqa: E402
+
+
+def sample_products():
+    now = datetime.now(timezone.utc)
+    return [
+        {**product, "id": product_id, "tax_rate": 0.10, "is_available": True, "created_at": now}
+        for product_id, product in zip(server.INITIAL_PRODUCT_IDS, server.INITIAL_PRODUCTS)
+    ]
+
+
+def sample_orders(count):
+    products = sample_products()
+    start = datetime.now(timezone.utc)
+    orders = []
+    for i in range(count):
+        items = [
+            {
+                "product_id": p["id"],
+                "quantity": 1 + (i + j) % 3,
+                "product_name": p["name"],
+                "price": p["price"],
+                "tax_rate": 0.10
+            }
+            for j, p in enumerate(products[i % 5:i % 5 + 3])
+        ]
+        total = sum(item["price"] * item["quantity"] for item in items)
+        created_at = start - timedelta(minutes=i)
+        orders.append({
+            "id": str(uuid.uuid4()),
+            "items": items,
+            "customer_name": f"Cliente {i}",
+            "customer_email": f"cliente{i}@example.com",
+            "customer_phone": "600000000",
+            "pickup_time": "13:30",
+            "notes": "",
+            "subtotal": round(total / 1.1, 2),
+            "tax": round(total - total / 1.1, 2),
+            "tax_breakdown": {"0.10": round(total - total / 1.1, 2)},
+            "total": round(total, 2),
+            "status": "paid",
+            "payment_method": "stripe",
+            "payment_session_id": f"cs_test_{i}",
+            "created_at": created_at,
+            "status_updated_at": created_at,
+            "status_timestamps": {"pending": created_at, "paid": created_at}
+        })
+    return orders
+
+
+def default_path(adapter, docs):
+    # Lo que hace FastAPI con response_model + JSONResponse
+    content = adapter.dump_python(adapter.validate_python(docs), mode="json")
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode()
+
+
+def fast_path(dump, docs):
+    return orjson.dumps(dump.many(docs))
+
+
+def cpu_per_call(fn, iterations):
+    fn()
+    start = time.process_time()
+    for _ in range(iterations):
+        fn()
+    return (time.process_time() - start) / iterations
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=2000)
+    parser.add_argument("--orders", type=int, default=100, help="Orders per list response")
+    args = parser.parse_args()
+
+    cases = {
+        "GET /api/products": (TypeAdapter(List[server.Product]), server.product_dump, sample_products()),
+        "GET /api/orders": (TypeAdapter(List[server.Order]), server.order_dump, sample_orders(args.orders)),
+    }
+
+    results = {}
+    for name, (adapter, dump, docs) in cases.items():
+        default_cpu = cpu_per_call(lambda: default_path(adapter, docs), args.iterations)
+        fast_cpu = cpu_per_call(lambda: fast_path(dump, docs), args.iterations)
+        results[name] = {
+            "documents": len(docs),
+            "default_us": round(default_cpu * 1e6, 1),
+            "fast_us": round(fast_cpu * 1e6, 1),
+            "saved_us": round((default_cpu - fast_cpu) * 1e6, 1),
+            "speedup": round(default_cpu / fast_cpu, 2) if fast_cpu else None
+        }
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
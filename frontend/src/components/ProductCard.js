@@ -2,6 +2,18 @@ import React from 'react';
 import { Plus } from 'lucide-react';
 import { useCart } from '../context/CartContext';
 
+const BACKEND_URL = process.env.REACT_APP_BACKEND_URL;
+
+// Grid columns: 1 on mobile, 2 on tablets, 3 on desktop
+const IMAGE_SIZES = '(min-width: 1024px) 33vw, (min-width: 768px) 50vw, 100vw';
+
+// srcset for one format of the generated image variants, if any
+const variantSrcSet = (variants, format) =>
+  (variants || [])
+    .filter(v => v.format === format)
+    .map(v => `${BACKEND_URL}${v.url} ${v.width}w`)
+    .join(', ');
+
 const ProductCard = ({ product, onClick }) => {
   const { addItem } = useCart();
 
@@ -24,11 +36,20 @@ const ProductCard = ({ product, onClick }) => {
     >
       {/* Image */}
       <div className="relative aspect-[4/3] overflow-hidden">
-        <img
-          src={product.image_url}
-          alt={product.name}
-          className="w-full h-full object-cover transform group-hover:scale-105 transition-transform duration-500"
-        />
+        <picture>
+          {['webp', 'jpeg'].map(format => {
+            const srcSet = variantSrcSet(product.image_variants, format);
+            return srcSet && (
+              <source key={format} type={`image/${format}`} srcSet={srcSet} sizes={IMAGE_SIZES} />
+            );
+          })}
+          <img
+            src={product.image_url}
+            alt={product.name}
+            loading="lazy"
+            className="w-full h-full object-cover transform group-hover:scale-105 transition-transform duration-500"
+          />
+        </picture>
         <div className="absolute inset-0 bg-gradient-to-t from-[#121212] via-transparent to-transparent" />
         
         {/* Category Badge */}
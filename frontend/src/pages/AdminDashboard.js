@@ -33,6 +33,23 @@ const AdminDashboard = () => {
     fetchData();
   }, [isAdmin, navigate]);
 
+  // Live order feed: keeps the orders list current without polling
+  useEffect(() => {
+    if (!isAdmin) return;
+
+    const source = new EventSource(`${API}/admin/orders/stream`);
+    source.addEventListener('order.created', (event) => {
+      const { order } = JSON.parse(event.data);
+      setOrders(prev => [order, ...prev.filter(o => o.id !== order.id)]);
+    });
+    source.addEventListener('order.status', (event) => {
+      const { order_id, status } = JSON.parse(event.data);
+      setOrders(prev => prev.map(o => (o.id === order_id ? { ...o, status } : o)));
+    });
+
+    return () => source.close();
+  }, [isAdmin]);
+
   const fetchData = async () => {
     setLoading(true);
     try {
@@ -51,6 +68,15 @@ const AdminDashboard = () => {
     }
   };
 
+  const fetchStats = async () => {
+    try {
+      const statsRes = await axios.get(`${API}/admin/stats`);
+      setStats(statsRes.data);
+    } catch (error) {
+      console.error('Error fetching stats:', error);
+    }
+  };
+
   const handleLogout = () => {
     logout();
     navigate('/');
@@ -69,10 +95,10 @@ const AdminDashboard = () => {
 
   const handleToggleAvailability = async (product) => {
     try {
-      await axios.put(`${API}/products/${product.id}`, {
+      const res = await axios.put(`${API}/products/${product.id}`, {
         is_available: !product.is_available
       });
-      fetchData();
+      setProducts(prev => prev.map(p => (p.id === product.id ? res.data : p)));
     } catch (error) {
       console.error('Error updating product:', error);
     }
@@ -81,12 +107,32 @@ const AdminDashboard = () => {
   const handleUpdateOrderStatus = async (orderId, status) => {
     try {
       await axios.put(`${API}/orders/${orderId}/status?status=${status}`);
-      fetchData();
+      // The live feed may be served by another worker: apply our own change now
+      setOrders(prev => prev.map(o => (o.id === orderId ? { ...o, status } : o)));
+      fetchStats();
     } catch (error) {
       console.error('Error updating order:', error);
     }
   };
 
+  // End of day: close every ready order in one request
+  const handleCompleteReadyOrders = async () => {
+    const ready = orders.filter(o => o.status === 'ready');
+    if (ready.length === 0) return;
+    try {
+      const res = await axios.post(`${API}/orders/bulk/status`, {
+        updates: ready.map(o => ({ order_id: o.id, status: 'completed' }))
+      });
+      const completed = new Set(
+        res.data.results.filter(r => r.result === 'updated').map(r => r.order_id)
+      );
+      setOrders(prev => prev.map(o => (completed.has(o.id) ? { ...o, status: 'completed' } : o)));
+      fetchStats();
+    } catch (error) {
+      console.error('Error completing orders:', error);
+    }
+  };
+
   const tabs = [
     { id: 'dashboard', label: 'Dashboard', icon: LayoutDashboard },
     { id: 'products', label: 'Productos', icon: Package },
@@ -112,6 +158,16 @@ const AdminDashboard = () => {
     cancelled: 'Cancelado'
   };
 
+  // Mirrors ORDER_TRANSITIONS on the backend
+  const statusTransitions = {
+    pending: ['paid', 'cancelled'],
+    paid: ['preparing', 'cancelled'],
+    preparing: ['ready', 'cancelled'],
+    ready: ['completed', 'cancelled'],
+    completed: [],
+    cancelled: []
+  };
+
   if (!isAdmin) return null;
 
   return (
@@ -336,7 +392,18 @@ const AdminDashboard = () => {
             {/* Orders Tab */}
             {activeTab === 'orders' && (
               <div className="space-y-4">
-                <h3 className="text-lg font-semibold text-white">Gestión de Pedidos</h3>
+                <div className="flex items-center justify-between">
+                  <h3 className="text-lg font-semibold text-white">Gestión de Pedidos</h3>
+                  <button
+                    onClick={handleCompleteReadyOrders}
+                    disabled={!orders.some(o => o.status === 'ready')}
+                    className="flex items-center space-x-2 bg-white/5 text-zinc-300 px-4 py-2 text-sm font-medium hover:bg-white/10 hover:text-white transition-colors disabled:opacity-40"
+                    data-testid="complete-ready-orders-button"
+                  >
+                    <CheckCircle className="w-4 h-4" />
+                    <span>Completar listos ({orders.filter(o => o.status === 'ready').length})</span>
+                  </button>
+                </div>
                 
                 {orders.length === 0 ? (
                   <div className="text-center py-12 bg-[#121212] border border-white/5">
@@ -368,15 +435,15 @@ const AdminDashboard = () => {
                           </div>
                           
                           <div className="flex flex-wrap gap-2">
-                            {['pending', 'paid', 'preparing', 'ready', 'completed'].map(status => (
+                            {['pending', 'paid', 'preparing', 'ready', 'completed', 'cancelled'].map(status => (
                               <button
                                 key={status}
                                 onClick={() => handleUpdateOrderStatus(order.id, status)}
-                                disabled={order.status === status}
+                                disabled={!(statusTransitions[order.status] || []).includes(status)}
                                 className={`px-3 py-1 text-xs font-medium transition-colors ${
                                   order.status === status
                                     ? 'bg-[#C08040] text-black'
-                                    : 'bg-white/5 text-zinc-400 hover:bg-white/10 hover:text-white'
+                                    : 'bg-white/5 text-zinc-400 hover:bg-white/10 hover:text-white disabled:opacity-30 disabled:hover:bg-white/5 disabled:hover:text-zinc-400'
                                 }`}
                               >
                                 {statusLabels[status]}
@@ -0,0 +1,81 @@
+"""Unit tests for the admission gates in front of order creation and checkout"""
+
+import asyncio
+
+import pytest
+
+server = pytest.importorskip("server")
+
+
+def test_token_bucket_burst_then_refill(clock):
+    bucket = server.TokenBucket(rate=2, burst=3)
+
+    assert [bucket.take() for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert bucket.take() == pytest.approx(0.5)
+
+    clock.now += 0.5
+    assert bucket.take() == 0.0
+
+    clock.now += 60
+    assert [bucket.take() for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert bucket.take() > 0
+
+
+def test_token_bucket_zero_rate_is_unlimited():
+    bucket = server.TokenBucket(rate=0, burst=0)
+    assert all(bucket.take() == 0.0 for _ in range(100))
+
+
+def _request(forwarded_for=None, peer="10.0.0.1"):
+    headers = [(b"x-forwarded-for", forwarded_for.encode())] if forwarded_for else []
+    return server.Request({"type": "http", "headers": headers, "client": (peer, 1234)})
+
+
+def test_client_ip_ignores_forwarded_for_without_trusted_proxies(monkeypatch):
+    monkeypatch.setattr(server, "TRUSTED_PROXY_HOPS", 0)
+    assert server.client_ip(_request("1.2.3.4")) == "10.0.0.1"
+
+
+def test_client_ip_takes_the_entry_added_by_the_trusted_proxy(monkeypatch):
+    monkeypatch.setattr(server, "TRUSTED_PROXY_HOPS", 1)
+    # El cliente puede inventarse las primeras entradas
+    assert server.client_ip(_request("6.6.6.6, 1.2.3.4")) == "1.2.3.4"
+    monkeypatch.setattr(server, "TRUSTED_PROXY_HOPS", 2)
+    assert server.client_ip(_request("6.6.6.6, 1.2.3.4, 172.16.0.2")) == "1.2.3.4"
+
+
+def _gate(per_client):
+    gate = server.AdmissionGate("test", concurrency=100, queue=0, queue_timeout=1, rate=0, burst=0,
+                                ip_rate=1, ip_burst=1, ip_concurrency=1)
+    gate.per_client = per_client
+    return gate
+
+
+async def _admit(gate, request):
+    """Enter the gate like a route dependency and keep the slot"""
+    held = gate(request)
+    await held.__anext__()
+    return held
+
+
+def test_gate_limits_each_client(clock):
+    async def scenario():
+        gate = _gate(per_client=True)
+        await _admit(gate, _request(peer="10.0.0.1"))
+        await _admit(gate, _request(peer="10.0.0.2"))
+        with pytest.raises(server.HTTPException) as excinfo:
+            await _admit(gate, _request(peer="10.0.0.1"))
+        assert excinfo.value.status_code == 429
+
+    asyncio.run(scenario())
+
+
+def test_gate_without_per_client_limits_shares_the_proxy_address(clock):
+    async def scenario():
+        gate = _gate(per_client=False)
+        # Detrás del ingress todos los clientes llegan con la misma IP
+        for _ in range(10):
+            await _admit(gate, _request(peer="10.0.0.1"))
+        assert not gate.ip_buckets
+
+    asyncio.run(scenario())
@@ -0,0 +1,37 @@
+"""Unit tests for propagating ingredient catalog prices to escandallos"""
+
+import pytest
+
+server = pytest.importorskip("server")
+
+
+def _line(name, quantity, unit_cost, unit="g"):
+    return {"name": name, "quantity": quantity, "unit": unit, "unit_cost": unit_cost,
+            "total_cost": round(quantity * unit_cost, 4)}
+
+
+def test_recompute_escandallos_reprices_matching_lines():
+    products = [
+        {"id": "a", "ingredients": [_line("Quinoa", 100, 0.01), _line("Aguacate", 50, 0.02)]},
+        {"id": "b", "ingredients": [_line("Aguacate", 80, 0.02)]},
+    ]
+    prices = {"Aguacate": server.CatalogIngredient(name="Aguacate", unit="g", unit_cost=0.03)}
+
+    updated = server.recompute_escandallos(products, prices)
+
+    assert [u["id"] for u in updated] == ["a", "b"]
+    assert updated[0]["ingredients"][0]["total_cost"] == 1.0
+    assert updated[0]["ingredients"][1]["unit_cost"] == 0.03
+    assert updated[0]["ingredients"][1]["total_cost"] == 1.5
+    assert updated[0]["food_cost"] == 2.5
+    assert updated[1]["food_cost"] == 2.4
+
+
+def test_recompute_escandallos_skips_other_units():
+    products = [{"id": "a", "ingredients": [_line("Aguacate", 1, 0.5, unit="ud")]}]
+    prices = {"Aguacate": server.CatalogIngredient(name="Aguacate", unit="g", unit_cost=0.03)}
+
+    updated = server.recompute_escandallos(products, prices)
+
+    assert updated[0]["ingredients"][0]["total_cost"] == 0.5
+    assert updated[0]["food_cost"] == 0.5
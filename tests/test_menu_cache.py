@@ -0,0 +1,20 @@
+"""Unit tests for the in-process menu cache"""
+
+import pytest
+
+server = pytest.importorskip("server")
+
+
+def test_menu_cache_is_bounded():
+    cache = server.MenuCache(ttl=60, max_entries=3)
+    for i in range(10):
+        cache._store((f"category-{i}", True), (cache.version, server.time.monotonic(), b"[]", '"etag"'))
+    assert list(cache._entries) == [("category-7", True), ("category-8", True), ("category-9", True)]
+
+
+def test_menu_cache_drops_expired_entries(clock):
+    cache = server.MenuCache(ttl=60, max_entries=10)
+    cache._store(("bowls", True), (cache.version, clock(), b"[]", '"a"'))
+    clock.now += 61
+    cache._store(("wraps", True), (cache.version, clock(), b"[]", '"b"'))
+    assert list(cache._entries) == [("wraps", True)]
@@ -0,0 +1,65 @@
+"""Unit tests for the request metrics middleware"""
+
+import asyncio
+
+import pytest
+
+server = pytest.importorskip("server")
+
+LABELS = ("GET", "unmatched")
+
+
+def _duration_sum():
+    series = server.HTTP_REQUEST_DURATION._series.get(LABELS)
+    return series[-2] if series else 0.0
+
+
+def test_streaming_response_is_measured_until_the_last_chunk():
+    in_flight_while_streaming = []
+
+    async def streaming_app(scope, receive, send):
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await asyncio.sleep(0.05)
+        in_flight_while_streaming.append(server.HTTP_IN_FLIGHT._values[LABELS])
+        await send({"type": "http.response.body", "body": b"data: x\n\n", "more_body": False})
+
+    async def scenario():
+        sent = []
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {"type": "http", "method": "GET", "path": "/not-a-route", "headers": []}
+        before = _duration_sum()
+        await server.MetricsMiddleware(streaming_app)(scope, None, send)
+        return before, sent
+
+    before, sent = asyncio.run(scenario())
+
+    assert [m["type"] for m in sent] == ["http.response.start", "http.response.body"]
+    assert in_flight_while_streaming == [1]
+    assert server.HTTP_IN_FLIGHT._values[LABELS] == 0
+    assert _duration_sum() - before >= 0.05
+
+
+def test_debug_headers_are_added_to_the_response_start(monkeypatch):
+    monkeypatch.setattr(server, "MONGO_DEBUG_HEADERS", True)
+
+    async def plain_app(scope, receive, send):
+        server.current_profile.get().record("find", "products", 1.5)
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b"{}"})
+
+    async def scenario():
+        sent = []
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {"type": "http", "method": "GET", "path": "/not-a-route", "headers": []}
+        await server.MetricsMiddleware(plain_app)(scope, None, send)
+        return dict(sent[0]["headers"])
+
+    headers = asyncio.run(scenario())
+    assert headers[b"x-mongo-round-trips"] == b"1"
+    assert headers[b"x-mongo-time-ms"] == b"1.5"
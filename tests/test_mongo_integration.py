@@ -0,0 +1,253 @@
+"""Integration tests against a real MongoDB (MONGO_URL); skipped when none is reachable.
+
+mongomock accepts queries a real server rejects (e.g. $expr in an upsert
+filter), so these run the write paths against mongod itself.
+"""
+
+import asyncio
+import os
+import uuid
+
+import pytest
+
+server = pytest.importorskip("server")
+pymongo = pytest.importorskip("pymongo")
+from motor.motor_asyncio import AsyncIOMotorClient  # noqa: E402
+
+
+def _mongo_available():
+    try:
+        pymongo.MongoClient(os.environ["MONGO_URL"], serverSelectionTimeoutMS=500).admin.command("ping")
+        return True
+    except pymongo.errors.PyMongoError:
+        return False
+
+
+pytestmark = pytest.mark.skipif(not _mongo_available(), reason="MongoDB not reachable at MONGO_URL")
+
+
+@pytest.fixture
+def run_with_db(monkeypatch):
+    """Run a coroutine function with server.db pointing at a throwaway database"""
+    def run(scenario):
+        async def main():
+            client = AsyncIOMotorClient(os.environ["MONGO_URL"], tz_aware=True)
+            name = f"entusanojuicio_test_{uuid.uuid4().hex[:8]}"
+            monkeypatch.setattr(server, "db", client[name])
+            server.invalidate_product_caches()
+            try:
+                await server.ensure_indexes()
+                return await scenario(server.db)
+            finally:
+                await client.drop_database(name)
+                client.close()
+                server.invalidate_product_caches()
+        return asyncio.run(main())
+    return run
+
+
+def test_reserve_pickup_slot_until_full(run_with_db, monkeypatch):
+    monkeypatch.setattr(server, "SLOT_CAPACITY", 2)
+
+    async def scenario(db):
+        await server.reserve_pickup_slot("2030-01-01T13:00")
+        await server.reserve_pickup_slot("2030-01-01T13:00")
+        with pytest.raises(server.HTTPException) as excinfo:
+            await server.reserve_pickup_slot("2030-01-01T13:00")
+        assert excinfo.value.status_code == 409
+        slot = await db.pickup_slots.find_one({"_id": "2030-01-01T13:00"})
+        assert (slot["reserved"], slot["capacity"], slot["day"], slot["time"]) == (2, 2, "2030-01-01", "13:00")
+
+        await server.release_pickup_slot("2030-01-01T13:00")
+        await server.reserve_pickup_slot("2030-01-01T13:00")
+
+    run_with_db(scenario)
+
+
+def test_concurrent_reservations_never_exceed_capacity(run_with_db, monkeypatch):
+    monkeypatch.setattr(server, "SLOT_CAPACITY", 5)
+
+    async def scenario(db):
+        results = await asyncio.gather(
+            *(server.reserve_pickup_slot("2030-01-01T14:00") for _ in range(20)),
+            return_exceptions=True
+        )
+        assert sum(r is None for r in results) == 5
+        assert all(r.status_code == 409 for r in results if r is not None)
+        slot = await db.pickup_slots.find_one({"_id": "2030-01-01T14:00"})
+        assert slot["reserved"] == 5
+
+    run_with_db(scenario)
+
+
+def test_reserve_respects_capacity_set_by_admin(run_with_db):
+    async def scenario(db):
+        await server.set_pickup_slot_capacity(server.date(2030, 1, 1), "15:00", capacity=1)
+        await server.reserve_pickup_slot("2030-01-01T15:00")
+        with pytest.raises(server.HTTPException):
+            await server.reserve_pickup_slot("2030-01-01T15:00")
+
+    run_with_db(scenario)
+
+
+def test_pending_orders_expire_only_with_an_expired_checkout(run_with_db, monkeypatch):
+    states = {"cs_open": "open", "cs_expired": "expired"}
+
+    async def fake_state(session_id):
+        return states[session_id]
+
+    monkeypatch.setattr(server, "checkout_session_state", fake_state)
+    created_at = server.datetime.now(server.timezone.utc) - server.timedelta(hours=2)
+
+    async def scenario(db):
+        for order_id, session_id in (("open", "cs_open"), ("expired", "cs_expired"), ("abandoned", None)):
+            await db.orders.insert_one({
+                "id": order_id, "status": "pending", "payment_session_id": session_id,
+                "created_at": created_at, "items": [], "total": 0.0
+            })
+        assert await server.expire_pending_orders() == 2
+        statuses = {o["id"]: o["status"] async for o in db.orders.find({}, {"id": 1, "status": 1})}
+        assert statuses == {"open": "pending", "expired": "cancelled", "abandoned": "cancelled"}
+
+        # Un pago que llega después de cancelar queda marcado para reembolso
+        await server.mark_session_paid("cs_expired")
+        order = await db.orders.find_one({"id": "expired"})
+        assert order["status"] == "cancelled"
+        assert order["paid_after_cancel"] is True
+
+    run_with_db(scenario)
+
+
+def test_stock_refresh_rechecks_after_a_concurrent_restock(run_with_db, monkeypatch):
+    async def scenario(db):
+        await db.stock.insert_one({"name": "Aguacate", "quantity": 500.0})
+        await db.products.insert_one({
+            "id": "bowl", "name": "Bowl", "is_available": True,
+            "ingredients": [{"name": "Aguacate", "quantity": 100}]
+        })
+        real_read_stock = server.read_stock
+        reads = []
+
+        async def read_before_restock(names):
+            reads.append(names)
+            # La primera lectura es anterior a un reabastecimiento concurrente
+            if len(reads) == 1:
+                return {"Aguacate": 20.0}
+            return await real_read_stock(names)
+
+        monkeypatch.setattr(server, "read_stock", read_before_restock)
+        await server.refresh_stock_availability(["Aguacate"])
+
+        product = await db.products.find_one({"id": "bowl"})
+        assert product["is_available"] is True
+        assert len(reads) == 3
+
+    run_with_db(scenario)
+
+
+def test_stock_refresh_disables_and_reenables(run_with_db):
+    async def scenario(db):
+        await db.stock.insert_one({"name": "Aguacate", "quantity": 50.0})
+        await db.products.insert_one({
+            "id": "bowl", "name": "Bowl", "is_available": True,
+            "ingredients": [{"name": "Aguacate", "quantity": 100}]
+        })
+        await server.refresh_stock_availability(["Aguacate"])
+        product = await db.products.find_one({"id": "bowl"})
+        assert (product["is_available"], product["unavailable_reason"]) == (False, "stock")
+
+        await db.stock.update_one({"name": "Aguacate"}, {"$set": {"quantity": 400.0}})
+        await server.refresh_stock_availability(["Aguacate"])
+        product = await db.products.find_one({"id": "bowl"})
+        assert (product["is_available"], product["unavailable_reason"]) == (True, None)
+
+    run_with_db(scenario)
+
+
+def test_required_indexes_match_after_creation(run_with_db):
+    async def scenario(db):
+        # Una segunda pasada no debe reconstruir nada (p.ej. el TTL parcial del inbox)
+        for collection_name, keys, options in server.REQUIRED_INDEXES:
+            existing = (await db[collection_name].index_information())[options["name"]]
+            assert server._index_matches(existing, keys, options), options["name"]
+        ttl = (await db.webhook_inbox.index_information())["processed_at_ttl"]
+        assert ttl["expireAfterSeconds"] == int(server.WEBHOOK_RETENTION_DAYS * 86400)
+
+    run_with_db(scenario)
+
+
+async def _seed_bowl(db):
+    await db.products.insert_one({
+        "id": "bowl", "name": "Bowl", "category": "bowls", "price": 10.0, "tax_rate": 0.10, "is_available": True,
+        "ingredients": [{"name": "Aguacate", "quantity": 100, "unit": "g", "unit_cost": 0.02, "total_cost": 2.0}]
+    })
+    await db.stock.insert_one({"name": "Aguacate", "quantity": 1000.0})
+    await server.rebuild_order_stats()
+
+
+def _new_order(quantity=2, pickup_time="2030-01-01T13:00"):
+    return server.OrderCreate(
+        items=[server.CartItem(product_id="bowl", quantity=quantity, product_name="x", price=0.01)],
+        customer_name="Ana", customer_email="ana@example.com", customer_phone="600000000",
+        pickup_time=pickup_time
+    )
+
+
+def test_order_lifecycle_updates_derived_data(run_with_db):
+    async def scenario(db):
+        await _seed_bowl(db)
+
+        order = await server.create_order(_new_order())
+        assert order.total == 20.0
+        assert (await db.orders.find_one({"id": order.id}))["status"] == "pending"
+        assert (await db.pickup_slots.find_one({"_id": order.pickup_slot}))["reserved"] == 1
+        assert (await db.stats.find_one({"_id": "orders"}))["by_status"] == {"pending": 1}
+
+        await server.update_order_status(order.id, "paid")
+        stats = await db.stats.find_one({"_id": "orders"})
+        assert (stats["by_status"]["paid"], stats["revenue"]) == (1, 20.0)
+        assert (await db.stock.find_one({"name": "Aguacate"}))["quantity"] == 800.0
+        sales = await db.daily_sales.find_one({"product_id": "bowl"})
+        assert (sales["units"], sales["revenue"]) == (2, 20.0)
+
+        # Compare-and-set: repetir es idempotente y un salto no permitido es 409
+        await server.update_order_status(order.id, "paid")
+        with pytest.raises(server.HTTPException) as excinfo:
+            await server.update_order_status(order.id, "completed")
+        assert excinfo.value.status_code == 409
+
+        await server.update_order_status(order.id, "cancelled")
+        assert (await db.pickup_slots.find_one({"_id": order.pickup_slot}))["reserved"] == 0
+        assert (await db.stock.find_one({"name": "Aguacate"}))["quantity"] == 1000.0
+        sales = await db.daily_sales.find_one({"product_id": "bowl"})
+        assert (sales["units"], sales["revenue"]) == (0, 0.0)
+        # Los contadores incrementales coinciden con una agregación completa
+        stats = await db.stats.find_one({"_id": "orders"})
+        computed = await server.compute_order_stats()
+        assert {s: n for s, n in stats["by_status"].items() if n} == computed["by_status"] == {"cancelled": 1}
+        assert (stats["total_orders"], stats["revenue"]) == (computed["total_orders"], computed["revenue"])
+
+    run_with_db(scenario)
+
+
+def test_create_order_rejects_a_full_slot_without_inserting(run_with_db, monkeypatch):
+    monkeypatch.setattr(server, "SLOT_CAPACITY", 1)
+
+    async def scenario(db):
+        await _seed_bowl(db)
+        await server.create_order(_new_order())
+        with pytest.raises(server.HTTPException) as excinfo:
+            await server.create_order(_new_order())
+        assert excinfo.value.status_code == 409
+        assert await db.orders.count_documents({}) == 1
+
+    run_with_db(scenario)
+
+
+def test_unknown_order_status_update_is_404(run_with_db):
+    async def scenario(db):
+        with pytest.raises(server.HTTPException) as excinfo:
+            await server.update_order_status("missing", "paid")
+        assert excinfo.value.status_code == 404
+
+    run_with_db(scenario)
@@ -0,0 +1,39 @@
+"""Unit tests for the resumable order feed"""
+
+import asyncio
+
+import pytest
+
+server = pytest.importorskip("server")
+
+
+def test_resume_token_accepts_change_stream_ids():
+    token = "8265F1A2B3000000012B022C0100296E5A1004"
+    assert server.change_stream_resume_token(token) == {"_data": token}
+
+
+@pytest.mark.parametrize("last_event_id", [None, "", "abcd1234-5", "not a token", "82AB"])
+def test_resume_token_rejects_other_ids(last_event_id):
+    assert server.change_stream_resume_token(last_event_id) is None
+
+
+def test_bus_replays_events_after_last_event_id():
+    async def scenario():
+        bus = server.OrderEventBus(history=10)
+        for i in range(3):
+            bus.publish({"type": "order.created", "n": i})
+        _, missed = bus.subscribe(f"{bus.boot_id}-1")
+        assert [event["n"] for _, event in missed] == [1, 2]
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.parametrize("suffix", ["-x", "", "-"])
+def test_bus_ignores_malformed_last_event_id(suffix):
+    async def scenario():
+        bus = server.OrderEventBus(history=10)
+        bus.publish({"type": "order.created"})
+        _, missed = bus.subscribe(bus.boot_id + suffix)
+        assert missed == []
+
+    asyncio.run(scenario())
@@ -0,0 +1,26 @@
+"""Unit tests for the incremental order stats counters"""
+
+import pytest
+
+server = pytest.importorskip("server")
+
+
+def test_status_change_inc_new_order():
+    assert server.status_change_inc(None, "pending", 12.5) == {"by_status.pending": 1, "seq": 1, "total_orders": 1}
+
+
+def test_status_change_inc_moves_counters():
+    inc = server.status_change_inc("pending", "paid", 12.5)
+    assert inc["by_status.pending"] == -1
+    assert inc["by_status.paid"] == 1
+    assert "total_orders" not in inc
+
+
+def test_status_change_inc_revenue_stays_through_the_kitchen():
+    assert server.status_change_inc("pending", "paid", 12.5)["revenue"] == 12.5
+    for old, new in (("paid", "preparing"), ("preparing", "ready"), ("ready", "completed")):
+        assert "revenue" not in server.status_change_inc(old, new, 12.5)
+
+
+def test_status_change_inc_revenue_leaves_on_cancel():
+    assert server.status_change_inc("paid", "cancelled", 12.5)["revenue"] == -12.5
@@ -0,0 +1,20 @@
+"""Unit tests for the order status transitions used by the compare-and-set writes"""
+
+import pytest
+
+server = pytest.importorskip("server")
+
+
+def test_transitions_follow_the_kitchen_flow():
+    assert server.ORDER_TRANSITIONS["pending"] == ("paid", "cancelled")
+    assert server.ORDER_TRANSITIONS["ready"] == ("completed", "cancelled")
+    assert server.ORDER_TRANSITIONS["completed"] == ()
+    assert server.ORDER_TRANSITIONS["cancelled"] == ()
+    assert set(server.ORDER_TRANSITIONS) == set(server.ORDER_STATUSES)
+
+
+def test_statuses_leading_to():
+    assert server.statuses_leading_to("paid") == ["pending"]
+    assert server.statuses_leading_to("completed") == ["ready"]
+    assert server.statuses_leading_to("cancelled") == ["pending", "paid", "preparing", "ready"]
+    assert server.statuses_leading_to("pending") == []
@@ -0,0 +1,24 @@
+"""Unit tests for the keyset cursors of GET /api/orders"""
+
+from datetime import datetime, timezone
+
+import pytest
+
+server = pytest.importorskip("server")
+
+
+def test_cursor_round_trip():
+    created_at = datetime(2026, 3, 10, 12, 30, 15, 123000, tzinfo=timezone.utc)
+    cursor = server.encode_cursor({"created_at": created_at, "id": "abc"})
+    assert server.decode_cursor(cursor) == (created_at, "abc")
+
+
+def test_decode_cursor_rejects_garbage():
+    with pytest.raises(server.HTTPException) as excinfo:
+        server.decode_cursor("not-a-cursor")
+    assert excinfo.value.status_code == 400
+
+
+def test_cursor_accepts_legacy_string_dates():
+    cursor = server.encode_cursor({"created_at": "2026-03-10T12:30:15+00:00", "id": "abc"})
+    assert server.decode_cursor(cursor) == (datetime(2026, 3, 10, 12, 30, 15, tzinfo=timezone.utc), "abc")
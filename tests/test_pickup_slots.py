@@ -0,0 +1,34 @@
+"""Unit tests for pickup slot keys"""
+
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+import pytest
+
+server = pytest.importorskip("server")
+
+
+def _local(*args):
+    return datetime(*args, tzinfo=ZoneInfo(server.BUSINESS_TIMEZONE))
+
+
+def test_pickup_slot_key_rounds_down_to_the_slot():
+    assert server.pickup_slot_key("13:29", now=_local(2026, 3, 10, 12, 0)) == "2026-03-10T13:15"
+
+
+def test_pickup_slot_key_rolls_over_after_midnight():
+    assert server.pickup_slot_key("00:15", now=_local(2026, 3, 10, 23, 50)) == "2026-03-11T00:15"
+
+
+def test_pickup_slot_key_keeps_recent_times_today():
+    # Un retraso de menos de una hora sigue siendo hoy
+    assert server.pickup_slot_key("13:00", now=_local(2026, 3, 10, 13, 30)) == "2026-03-10T13:00"
+
+
+def test_pickup_slot_key_explicit_date():
+    assert server.pickup_slot_key("2026-03-12T20:40") == "2026-03-12T20:30"
+
+
+def test_pickup_slot_key_rejects_garbage():
+    with pytest.raises(server.HTTPException):
+        server.pickup_slot_key("25:00", now=_local(2026, 3, 10, 12, 0))
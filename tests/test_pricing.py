@@ -0,0 +1,42 @@
+"""Unit tests for server-side order pricing"""
+
+import asyncio
+
+import pytest
+
+server = pytest.importorskip("server")
+
+
+def _products(*docs):
+    async def lookup(product_ids):
+        return {d["id"]: d for d in docs if d["id"] in product_ids}
+    return lookup
+
+
+def test_price_order_items_rounding_and_tax_breakdown(monkeypatch):
+    monkeypatch.setattr(server.product_price_index, "lookup", _products(
+        {"id": "bowl", "name": "Bowl", "price": 11.95, "tax_rate": 0.10, "is_available": True},
+        {"id": "agua", "name": "Agua", "price": 1.99, "tax_rate": 0.21, "is_available": True},
+    ))
+    items = [
+        server.CartItem(product_id="bowl", quantity=3, product_name="x", price=0.01),
+        server.CartItem(product_id="agua", quantity=2, product_name="x", price=0.01),
+    ]
+    priced, pricing = asyncio.run(server.price_order_items(items))
+
+    # El precio del cliente se ignora: manda el catálogo
+    assert [item.price for item in priced] == [11.95, 1.99]
+    assert pricing["total"] == 39.83
+    assert pricing["tax_breakdown"] == {"0.10": 3.26, "0.21": 0.69}
+    assert pricing["subtotal"] == round(35.85 / 1.10 + 3.98 / 1.21, 2)
+    assert pricing["tax"] == round(pricing["total"] - (35.85 / 1.10 + 3.98 / 1.21), 2)
+
+
+def test_price_order_items_rejects_unavailable(monkeypatch):
+    monkeypatch.setattr(server.product_price_index, "lookup", _products(
+        {"id": "bowl", "name": "Bowl", "price": 11.95, "is_available": False},
+    ))
+    items = [server.CartItem(product_id="bowl", quantity=1, product_name="Bowl", price=11.95)]
+    with pytest.raises(server.HTTPException) as excinfo:
+        asyncio.run(server.price_order_items(items))
+    assert excinfo.value.status_code == 400
@@ -0,0 +1,27 @@
+"""Unit tests for the stock ledger in backend/server.py"""
+
+import pytest
+
+server = pytest.importorskip("server")
+
+
+def test_product_quantities_sums_duplicate_lines():
+    items = [
+        {"product_id": "bowl", "quantity": 2},
+        {"product_id": "wrap", "quantity": 1},
+        {"product_id": "bowl", "quantity": 3},
+    ]
+    assert server.product_quantities(items) == {"bowl": 5, "wrap": 1}
+
+
+def test_ingredient_consumption_counts_duplicate_lines():
+    recipes = {"bowl": [{"name": "Quinoa", "quantity": 100}, {"name": "Aguacate", "quantity": 50}]}
+    items = [{"product_id": "bowl", "quantity": 1}, {"product_id": "bowl", "quantity": 2}]
+    assert server.ingredient_consumption(items, recipes) == {"Quinoa": 300, "Aguacate": 150}
+
+
+def test_stock_sign():
+    assert server.stock_sign("pending", "paid") == -1
+    assert server.stock_sign("paid", "preparing") == 0
+    assert server.stock_sign("ready", "cancelled") == 1
+    assert server.stock_sign("pending", "cancelled") == 0